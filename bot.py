@@ -1,21 +1,40 @@
 import os
+import time
+
+# Отсчёт времени старта — до импорта зависимостей
+_BOOT_STARTED = time.perf_counter()
+
 import asyncio
+import logging
 import calendar
-from datetime import date, timedelta
-from typing import Optional
+from datetime import date, datetime, time as dt_time, timedelta
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
 
 from dotenv import load_dotenv
 from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import TimedOut, NetworkError
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter, TimedOut, NetworkError
 from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
 
-from iiko_client import IikoClient
-from cashflow import (
-    build_excel_cashflow_table,
-    build_full_cashflow_tree,
-    export_excel_cashflow,
+from file_index import TelegramFileIndex
+from rate_limiter import SendRateLimiter
+from iiko_client import DEFAULT_TOKEN_TTL, AsyncIikoClient, aclose_shared_async_clients, get_shared_async_client
+from olap_cache import DEFAULT_MAX_ENTRIES, DEFAULT_OPEN_TTL, OlapCache
+from report_cache import (
+    DEFAULT_REPORT_CACHE_BYTES,
+    DEFAULT_REPORT_CACHE_ENTRIES,
+    Artefact,
+    ReportCache,
+    payload_fingerprint,
 )
+from report_scheduler import DEFAULT_REPORT_QUEUE_SIZE, DEFAULT_REPORT_WORKERS, ReportQueueFull, ReportScheduler
+from singleflight import SingleFlight
+# report_worker импортирует cashflow (pandas/numpy) только при первом отчёте
+import report_worker
+from snapshot_store import SnapshotStore
+from storage import DEFAULT_DATA_DIR
+from subscriptions import SUBSCRIPTION_FORMATS, Subscription, SubscriptionStore
 # Local JSON loader no longer used in bot flow
 
 
@@ -94,14 +113,263 @@ def _build_calendar(
     return InlineKeyboardMarkup(rows)
 
 
-def _start_iiko_client() -> IikoClient:
+_olap_cache: Optional[OlapCache] = None
+
+
+def _get_olap_cache() -> OlapCache:
+    global _olap_cache
+    if _olap_cache is None:
+        # Снимки закрытых дней на диске переживают перезапуск контейнера
+        store = SnapshotStore.in_data_dir(get_env("DATA_DIR", DEFAULT_DATA_DIR))
+        _olap_cache = OlapCache(
+            max_entries=int(get_env("OLAP_CACHE_SIZE", str(DEFAULT_MAX_ENTRIES))),
+            open_ttl=float(get_env("OLAP_CACHE_TTL", str(DEFAULT_OPEN_TTL))),
+            store=store,
+        )
+    return _olap_cache
+
+
+def _start_iiko_client() -> AsyncIikoClient:
+    # Общий асинхронный клиент: сессия, пул соединений и токен переиспользуются между колбэками
     base_url = get_env("IIKO_BASE_URL")
     login = get_env("IIKO_LOGIN")
     password = get_env("IIKO_PASSWORD")
-    return IikoClient(base_url=base_url, login=login, password=password)
+    token_ttl = float(get_env("IIKO_TOKEN_TTL", str(DEFAULT_TOKEN_TTL)))
+    return get_shared_async_client(
+        base_url=base_url,
+        login=login,
+        password=password,
+        token_ttl=token_ttl,
+        cache=_get_olap_cache(),
+    )
+
+
+async def _fetch_olap_pair(
+    client: AsyncIikoClient,
+    preset_id: str,
+    previous: Tuple[str, str],
+    current: Tuple[str, str],
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    # Срезы независимы: запрашиваем параллельно по одной авторизованной сессии
+    refresh = _olap_refresh.get()
+    raw_previous, raw_current = await asyncio.gather(
+        client.fetch_olap_by_preset(preset_id, date_from=previous[0], date_to=previous[1], refresh=refresh),
+        client.fetch_olap_by_preset(preset_id, date_from=current[0], date_to=current[1], refresh=refresh),
+    )
+    return raw_previous, raw_current
+
+
+# === Фоновые отчёты и статус выполнения ===
+
+# Этапы отчёта, которые видит пользователь в статусном сообщении
+STAGE_QUEUED = "формируется…"
+STAGE_FETCHING = "получение данных из iiko…"
+STAGE_BUILDING = "построение отчёта…"
+STAGE_WAITING = "в очереди…"
+STAGE_UPLOADING = "отправка…"
+
+
+class ReportProgress:
+    """Статусное сообщение фонового отчёта: правится на месте при смене этапа."""
+
+    def __init__(self, message, title: str):
+        self.message = message
+        self.title = title
+        self.loop = asyncio.get_running_loop()
+        self._last: Optional[str] = None
+        self._pending: Optional["asyncio.Task[None]"] = None
+
+    async def _show(self, text: str) -> None:
+        if text == self._last:
+            return
+        self._last = text
+        try:
+            await self.message.edit_text(text)
+        except Exception:
+            # Сообщение удалено или не изменилось — статус не критичен для отчёта
+            pass
+
+    async def stage(self, stage: str) -> None:
+        await self._show(f"⏳ {self.title}: {stage}")
+
+    def stage_soon(self, stage: str) -> None:
+        # Из синхронного кода в event loop: правка статуса не задерживает вызывающего
+        self._pending = self.loop.create_task(self.stage(stage))
+
+    async def finish(self, ok: bool, reason: str = "не удалось сформировать, попробуйте ещё раз") -> None:
+        if ok:
+            await self._show(f"✅ {self.title}: готово")
+        else:
+            await self._show(f"❌ {self.title}: {reason}")
+
+
+# Колбэк этапов текущего фонового отчёта; генераторы сообщают этапы через _report_stage
+_report_progress: ContextVar[Optional[ReportProgress]] = ContextVar("report_progress", default=None)
+
+
+async def _report_stage(stage: str) -> None:
+    progress = _report_progress.get()
+    if progress is not None:
+        await progress.stage(stage)
+
+
+async def _start_report_job(
+    context: ContextTypes.DEFAULT_TYPE,
+    message,
+    title: str,
+    job: Callable[[], Awaitable[None]],
+) -> None:
+    # Обработчик только меняет статус и сразу возвращается; отчёт строится в фоне
+    progress = ReportProgress(message, title)
+    await progress.stage(STAGE_QUEUED)
+    context.application.create_task(_run_report_job(progress, job), name=f"report:{title}")
+
+
+async def _run_report_job(progress: ReportProgress, job: Callable[[], Awaitable[None]]) -> None:
+    _report_progress.set(progress)
+    try:
+        await job()
+    except ReportQueueFull:
+        logging.warning("Report queue is full, rejected: %s", progress.title)
+        await progress.finish(ok=False, reason="сейчас слишком много запросов, попробуйте через минуту")
+    except Exception:
+        logging.exception("Report job failed: %s", progress.title)
+        await progress.finish(ok=False)
+    else:
+        await progress.finish(ok=True)
+    try:
+        await progress.message.reply_text(
+            "Выберите режим получения отчёта:",
+            reply_markup=_build_main_menu(),
+        )
+    except Exception:
+        pass
+
+
+# Одинаковые отчёты (режим + даты), запрошенные одновременно, строятся один раз
+_report_flights = SingleFlight()
+
+
+class ReportFile(NamedTuple):
+    """Готовый XLSX и его ключ в индексе file_id (вид отчёта, диапазон дат, отпечаток данных)."""
+
+    content: bytes
+    filename: str
+    kind: str = ""
+    date_range: str = ""
+    fingerprint: str = ""
+
+
+_report_cache: Optional[ReportCache] = None
+
+
+def _get_report_cache() -> ReportCache:
+    global _report_cache
+    if _report_cache is None:
+        _report_cache = ReportCache(
+            max_entries=int(get_env("REPORT_CACHE_SIZE", str(DEFAULT_REPORT_CACHE_ENTRIES))),
+            max_bytes=int(float(get_env("REPORT_CACHE_MB", str(DEFAULT_REPORT_CACHE_BYTES / 2**20))) * 2**20),
+        )
+    return _report_cache
+
 
+_report_scheduler: Optional[ReportScheduler] = None
 
-def _generate_xlsx_for_day(iso_day: str) -> str:
+
+def _get_report_scheduler() -> ReportScheduler:
+    global _report_scheduler
+    if _report_scheduler is None:
+        _report_scheduler = ReportScheduler(
+            workers=int(get_env("REPORT_WORKERS", str(DEFAULT_REPORT_WORKERS))),
+            max_queue=int(get_env("REPORT_QUEUE_SIZE", str(DEFAULT_REPORT_QUEUE_SIZE))),
+            processes=_use_process_pool(),
+            initializer=report_worker.warm_up,
+        )
+    return _report_scheduler
+
+
+def _use_process_pool() -> bool:
+    # REPORT_EXECUTOR=process — построение в отдельных процессах (параллельно, без GIL event loop)
+    return get_env("REPORT_EXECUTOR", "thread").strip().lower() == "process"
+
+
+# Отчёты, построенные заранее по расписанию: (вид, даты) -> (время построения, отпечаток).
+# Пока запись свежее PRERENDER_INTERVAL_MIN, кнопка отдаёт отчёт без запроса к iiko.
+_prerendered: Dict[Tuple[str, ...], Tuple[float, str]] = {}
+_prerender_mode: ContextVar[bool] = ContextVar("prerender_mode", default=False)
+# Срезы OLAP запрашиваются заново мимо кэша, свежий ответ перезаписывает кэш и снимок
+_olap_refresh: ContextVar[bool] = ContextVar("olap_refresh", default=False)
+
+
+def _prerender_interval() -> float:
+    return float(get_env("PRERENDER_INTERVAL_MIN", "10")) * 60
+
+
+def _prerendered_report(kind: str, params: Tuple[str, ...]) -> Optional[Tuple[Artefact, str]]:
+    # Само предварительное построение всегда идёт в iiko за свежими данными
+    if _prerender_mode.get():
+        return None
+    entry = _prerendered.get((kind, *params))
+    if entry is None or time.monotonic() - entry[0] > _prerender_interval():
+        return None
+    artefact = _get_report_cache().get((kind, *params, entry[1]))
+    return (artefact, entry[1]) if artefact is not None else None
+
+
+async def _cached_report(
+    kind: str,
+    params: Tuple[str, ...],
+    payloads: Tuple[Any, ...],
+    render: Callable[..., Artefact],
+    *render_args: Any,
+) -> Tuple[Artefact, str]:
+    # Ключ — вид отчёта, даты и отпечаток данных: пока данные дня не изменились, отчёт не перестраивается
+    fingerprint = await asyncio.to_thread(payload_fingerprint, *payloads)
+    key: Hashable = (kind, *params, fingerprint)
+    cache = _get_report_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        _remember_prerendered(kind, params, fingerprint)
+        return cached, fingerprint
+    scheduler = _get_report_scheduler()
+    progress = _report_progress.get()
+    chat_id = getattr(progress.message, "chat_id", None) if progress is not None else None
+    if scheduler.busy():
+        # Место в очереди с учётом обхода чатов по кругу, а не общая длина очереди
+        ahead = scheduler.jobs_ahead(chat_id)
+        await _report_stage(f"в очереди, перед вами {ahead}…" if ahead else STAGE_WAITING)
+    else:
+        await _report_stage(STAGE_BUILDING)
+    # Построение идёт через ограниченный пул: одновременно не больше REPORT_WORKERS отчётов.
+    # render — функция report_worker: в режиме процессов аргументы передаются pickle
+    artefact = await scheduler.submit(
+        chat_id,
+        render,
+        *render_args,
+        on_start=(lambda: progress.stage_soon(STAGE_BUILDING)) if progress is not None else None,
+    )
+    cache.put(key, artefact)
+    _remember_prerendered(kind, params, fingerprint)
+    return artefact, fingerprint
+
+
+def _remember_prerendered(kind: str, params: Tuple[str, ...], fingerprint: str) -> None:
+    if _prerender_mode.get():
+        _prerendered[(kind, *params)] = (time.monotonic(), fingerprint)
+
+
+_file_index: Optional[TelegramFileIndex] = None
+
+
+def _get_file_index() -> TelegramFileIndex:
+    global _file_index
+    if _file_index is None:
+        _file_index = TelegramFileIndex.in_data_dir(get_env("DATA_DIR", DEFAULT_DATA_DIR))
+    return _file_index
+
+
+@_report_flights.coalesce("xlsx_day")
+async def _generate_xlsx_for_day(iso_day: str) -> ReportFile:
     client = _start_iiko_client()
     preset_id = get_env("IIKO_OLAP_PRESET_ID")
     try:
@@ -111,17 +379,29 @@ def _generate_xlsx_for_day(iso_day: str) -> str:
     date_from = d.isoformat()
     date_to = (d + timedelta(days=1)).isoformat()
     date_pre = (d - timedelta(days=1)).isoformat()
-    raw_previous = client.fetch_olap_by_preset(
-        preset_id, date_from=date_pre, date_to=date_from
+    ready = _prerendered_report("xlsx_day", (date_from,))
+    if ready is not None:
+        content, fingerprint = ready
+        return ReportFile(content, f"{date_from}_ДДС.xlsx", "xlsx_day", date_from, fingerprint)
+    await _report_stage(STAGE_FETCHING)
+    raw_previous, raw_current = await _fetch_olap_pair(
+        client, preset_id, (date_pre, date_from), (date_from, date_to)
     )
-    raw_current = client.fetch_olap_by_preset(
-        preset_id, date_from=date_from, date_to=date_to
+    # Сетевые запросы выполняются в event loop, в пул уходит только построение книги (в памяти)
+    content, fingerprint = await _cached_report(
+        "xlsx_day",
+        (date_from,),
+        (raw_previous, raw_current),
+        report_worker.render_day_xlsx,
+        raw_previous,
+        raw_current,
+        date_from,
     )
-    out_path = f"{date_from}_ДДС.xlsx"
-    return export_excel_cashflow(raw_previous, raw_current, date_from, path=out_path)
+    return ReportFile(content, f"{date_from}_ДДС.xlsx", "xlsx_day", date_from, fingerprint)
 
 
-def _generate_text_info_for_day(iso_day: str) -> str:
+@_report_flights.coalesce("text_day")
+async def _generate_text_info_for_day(iso_day: str) -> str:
     client = _start_iiko_client()
     preset_id = get_env("IIKO_OLAP_PRESET_ID")
     try:
@@ -131,19 +411,28 @@ def _generate_text_info_for_day(iso_day: str) -> str:
     date_from = d.isoformat()
     date_to = (d + timedelta(days=1)).isoformat()
     date_pre = (d - timedelta(days=1)).isoformat()
-    raw_previous = client.fetch_olap_by_preset(
-        preset_id, date_from=date_pre, date_to=date_from
+    ready = _prerendered_report("text_day", (date_from,))
+    if ready is not None:
+        return ready[0]
+    await _report_stage(STAGE_FETCHING)
+    raw_previous, raw_current = await _fetch_olap_pair(
+        client, preset_id, (date_pre, date_from), (date_from, date_to)
     )
-    raw_current = client.fetch_olap_by_preset(
-        preset_id, date_from=date_from, date_to=date_to
+    text, _ = await _cached_report(
+        "text_day",
+        (date_from,),
+        (raw_previous, raw_current),
+        report_worker.render_day_text,
+        raw_previous,
+        raw_current,
+        date_from,
     )
-    table = build_excel_cashflow_table(raw_previous, raw_current)
-    return build_full_cashflow_tree(table, date_str=date_from)
+    return text
 
 
-def _generate_xlsx_for_period(date_from: str, date_to: str) -> str:
+@_report_flights.coalesce("xlsx_period")
+async def _generate_xlsx_for_period(date_from: str, date_to: str) -> ReportFile:
     client = _start_iiko_client()
-    preset_id = get_env("IIKO_OLAP_PRESET_ID")
     try:
         dfrom_dt = date.fromisoformat(date_from)
         dto_dt = date.fromisoformat(date_to)
@@ -165,14 +454,44 @@ def _generate_xlsx_for_period(date_from: str, date_to: str) -> str:
         date_from = dfrom_dt.isoformat()
         date_to = dto_dt.isoformat()
         date_to_pre = dto_predt.isoformat()
-    raw_previous = client.fetch_olap_by_preset(
-        preset_id, date_from=date_pre, date_to=date_from
+    # Один запрос за весь диапазон с разбивкой по дням вместо запроса на каждую границу
+    await _report_stage(STAGE_FETCHING)
+    raw_days = await client.fetch_olap_transactions_by_day(date_pre, date_to_pre)
+    content, fingerprint = await _cached_report(
+        "xlsx_period",
+        (date_pre, date_to_pre, date_from),
+        (raw_days,),
+        report_worker.render_period_xlsx,
+        raw_days,
+        date_pre,
+        date_to_pre,
+        date_from,
     )
-    raw_current = client.fetch_olap_by_preset(
-        preset_id, date_from=date_to_pre, date_to=date_to
+    return ReportFile(
+        content, f"{date_from}-{date_to}_ДДС.xlsx", "xlsx_period", f"{date_from}..{date_to}", fingerprint
+    )
+
+
+async def _deliver_xlsx_day(message, iso_day: str) -> None:
+    report = await _generate_xlsx_for_day(iso_day)
+    await _report_stage(STAGE_UPLOADING)
+    await safe_reply_document(message, report, caption=f"Отчёт ДДС — {iso_day}")
+
+
+async def _deliver_text_day(message, iso_day: str) -> None:
+    text_info = await _generate_text_info_for_day(iso_day)
+    await _report_stage(STAGE_UPLOADING)
+    await message.reply_text(text_info)
+
+
+async def _deliver_xlsx_period(message, period_from: str, period_to: str) -> None:
+    report = await _generate_xlsx_for_period(period_from, period_to)
+    await _report_stage(STAGE_UPLOADING)
+    await safe_reply_document(
+        message,
+        report,
+        caption=f"Отчёт ДДС — период {period_from} — {period_to}",
     )
-    out_path = f"{date_from}-{date_to}_ДДС.xlsx"
-    return export_excel_cashflow(raw_previous, raw_current, date_from, path=out_path)
 
 
 async def _on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -209,30 +528,17 @@ async def _on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if data == "TODAY":
         # Только XLSX, без текстовых сообщений
         iso = date.today().isoformat()
-        path = await asyncio.to_thread(_generate_xlsx_for_day, iso)
-        await safe_reply_document(q.message, path, caption=f"Отчёт ДДС — {iso}")
-        try:
-            await q.message.reply_text(
-                "Выберите режим получения отчёта:",
-                reply_markup=_build_main_menu(),
-            )
-        except Exception:
-            pass
+        await _start_report_job(
+            context, q.message, f"Отчёт ДДС — {iso}", lambda: _deliver_xlsx_day(q.message, iso)
+        )
         return
 
 
     if data == "TODAY_TEXT":
-        # Только XLSX, без текстовых сообщений
         iso = date.today().isoformat()
-        text_info = await asyncio.to_thread(_generate_text_info_for_day, iso)
-        try:
-            await q.message.reply_text(text_info)
-            await q.message.reply_text(
-                "Выберите режим получения отчёта:",
-                reply_markup=_build_main_menu(),
-            )
-        except Exception:
-            pass
+        await _start_report_job(
+            context, q.message, f"Отчёт ДДС — {iso}", lambda: _deliver_text_day(q.message, iso)
+        )
         return
 
     if data == "DAY":
@@ -295,25 +601,14 @@ async def _on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         if action == "SET":
             iso_day = parts[2] if len(parts) > 2 else date.today().isoformat()
             if mode == "DAY":
-                path = await asyncio.to_thread(_generate_xlsx_for_day, iso_day)
-                await safe_reply_document(
-                    q.message, path, caption=f"Отчёт ДДС — {iso_day}"
+                await _start_report_job(
+                    context, q.message, f"Отчёт ДДС — {iso_day}", lambda: _deliver_xlsx_day(q.message, iso_day)
                 )
-                try:
-                    await q.message.reply_text("Выберите режим получения отчёта:",reply_markup=_build_main_menu())
-                except Exception:
-                    pass
                 return
             if mode == "DAY_TEXT":
-                text_info = await asyncio.to_thread(_generate_text_info_for_day, iso_day)
-                try:
-                    await q.message.reply_text(text_info)
-                    await q.message.reply_text(
-                        "Выберите режим получения отчёта:",
-                        reply_markup=_build_main_menu(),
-                    )
-                except Exception:
-                    pass
+                await _start_report_job(
+                    context, q.message, f"Отчёт ДДС — {iso_day}", lambda: _deliver_text_day(q.message, iso_day)
+                )
                 return
             elif mode == "PERIOD_FROM":
                 context.user_data["period_from"] = iso_day
@@ -333,28 +628,24 @@ async def _on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             elif mode == "PERIOD_TO":
                 period_from = context.user_data.get("period_from")
                 period_to = iso_day
+                # Сброс состояния; главное меню придёт после отчёта
+                context.user_data.pop("period_from", None)
+                context.user_data.pop("period_state", None)
                 if not period_from:
                     # если начало отсутствует — считаем одиночным днём
-                    path = await asyncio.to_thread(_generate_xlsx_for_day, period_to)
-                    await safe_reply_document(
-                        q.message, path, caption=f"Отчёт ДДС — {period_to}"
+                    await _start_report_job(
+                        context,
+                        q.message,
+                        f"Отчёт ДДС — {period_to}",
+                        lambda: _deliver_xlsx_day(q.message, period_to),
                     )
                 else:
-                    path = await asyncio.to_thread(
-                        _generate_xlsx_for_period, period_from, period_to
-                    )
-                    await safe_reply_document(
+                    await _start_report_job(
+                        context,
                         q.message,
-                        path,
-                        caption=f"Отчёт ДДС — период {period_from} — {period_to}",
+                        f"Отчёт ДДС — период {period_from} — {period_to}",
+                        lambda: _deliver_xlsx_period(q.message, period_from, period_to),
                     )
-                # Сброс состояния и возврат в главное меню
-                context.user_data.pop("period_from", None)
-                context.user_data.pop("period_state", None)
-                try:
-                    await q.edit_message_reply_markup(reply_markup=_build_main_menu())
-                except Exception:
-                    pass
                 return
 
     # Устаревшая команда /cashflow удалена: используйте кнопки в /start
@@ -370,38 +661,341 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 
+# === Ежедневная рассылка по подписке ===
+
+_subscriptions: Optional[SubscriptionStore] = None
+_send_limiter: Optional[SendRateLimiter] = None
+# Один проход рассылки за раз: следующий тик ждёт, пока не закончится текущий
+_push_lock = asyncio.Lock()
+
+SUBSCRIPTION_FORMAT_LABELS = {"xlsx": "XLSX", "text": "текст", "both": "XLSX и текст"}
+
+
+def _get_subscriptions() -> SubscriptionStore:
+    global _subscriptions
+    if _subscriptions is None:
+        _subscriptions = SubscriptionStore.in_data_dir(get_env("DATA_DIR", DEFAULT_DATA_DIR))
+    return _subscriptions
+
+
+def _get_send_limiter() -> SendRateLimiter:
+    global _send_limiter
+    if _send_limiter is None:
+        _send_limiter = SendRateLimiter()
+    return _send_limiter
+
+
+def _retry_after_seconds(exc: RetryAfter) -> float:
+    delay = exc.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+class _ChatTarget:
+    """Отправка в чат по chat_id через ограничитель частоты.
+
+    Повторяет нужную safe_reply_document часть интерфейса Message (reply_document, reply_text).
+    """
+
+    def __init__(self, bot, chat_id: int, limiter: SendRateLimiter):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.limiter = limiter
+
+    async def _send(self, method, **kwargs):
+        while True:
+            await self.limiter.wait(self.chat_id)
+            try:
+                return await method(chat_id=self.chat_id, **kwargs)
+            except RetryAfter as exc:
+                # Telegram просит подождать — ждём и повторяем
+                await asyncio.sleep(_retry_after_seconds(exc))
+
+    async def reply_document(self, document, caption: str | None = None):
+        return await self._send(self.bot.send_document, document=document, caption=caption)
+
+    async def reply_text(self, text: str, reply_markup=None):
+        return await self._send(self.bot.send_message, text=text, reply_markup=reply_markup)
+
+
+def _daily_push_max_attempts() -> int:
+    return int(get_env("DAILY_PUSH_MAX_ATTEMPTS", "5"))
+
+
+async def _push_reports(bot, due: List[Subscription], report_day: str, today: str) -> None:
+    # Отчёт за день строится один раз на всех подписчиков; после первой загрузки XLSX
+    # safe_reply_document отправляет остальным тот же file_id
+    pending = {sub.chat_id: sub.pending(today) for sub in due}
+    wants_xlsx = any("xlsx" in parts for parts in pending.values())
+    wants_text = any("text" in parts for parts in pending.values())
+    report = await _generate_xlsx_for_day(report_day) if wants_xlsx else None
+    text_info = await _generate_text_info_for_day(report_day) if wants_text else None
+
+    store = _get_subscriptions()
+    limiter = _get_send_limiter()
+    max_attempts = _daily_push_max_attempts()
+    sent = 0
+    for sub in due:
+        target = _ChatTarget(bot, sub.chat_id, limiter)
+        try:
+            # Каждая часть отмечается сразу после доставки: повтор досылает только недостающее
+            for part in pending[sub.chat_id]:
+                if part == "xlsx":
+                    await safe_reply_document(target, report, caption=f"Отчёт ДДС — {report_day}")
+                else:
+                    await target.reply_text(text_info)
+                store.mark_sent(sub.chat_id, part, today)
+        except ChatMigrated as exc:
+            # Группа стала супергруппой — подписка переезжает, доставка на следующем тике
+            store.migrate_chat(sub.chat_id, exc.new_chat_id)
+            logging.info("Chat %s migrated to %s, subscription moved", sub.chat_id, exc.new_chat_id)
+            continue
+        except (Forbidden, BadRequest) as exc:
+            # Бот заблокирован, удалён из чата или чата больше нет — подписка больше не нужна
+            if isinstance(exc, Forbidden) or "chat not found" in str(exc).lower():
+                store.unsubscribe(sub.chat_id)
+                logging.info("Chat %s is unreachable (%s), unsubscribed", sub.chat_id, exc)
+            else:
+                _record_push_failure(store, sub.chat_id, today, max_attempts)
+            continue
+        except Exception:
+            _record_push_failure(store, sub.chat_id, today, max_attempts)
+            continue
+        sent += 1
+    logging.info("Daily push for %s delivered to %d of %d chats", report_day, sent, len(due))
+
+
+def _record_push_failure(store: SubscriptionStore, chat_id: int, today: str, max_attempts: int) -> None:
+    failures = store.record_failure(chat_id, today)
+    logging.warning("Daily push to chat %s failed (attempt %d of %d)", chat_id, failures, max_attempts, exc_info=True)
+    if failures >= max_attempts:
+        logging.warning("Daily push to chat %s postponed until tomorrow", chat_id)
+
+
+async def _daily_push_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if _push_lock.locked():
+        return
+    async with _push_lock:
+        now = datetime.now()
+        today = now.date().isoformat()
+        store = _get_subscriptions()
+        max_attempts = _daily_push_max_attempts()
+        due = store.due(now.strftime("%H:%M"), today, max_attempts)
+        if not due:
+            return
+        report_day = (now.date() - timedelta(days=1)).isoformat()
+        try:
+            await _push_reports(context.bot, due, report_day, today)
+        except Exception:
+            # Отчёт не построился: попытка засчитывается всем ожидающим чатам,
+            # повтор на следующем тике, но не больше max_attempts за день
+            logging.warning("Daily push for %s failed", report_day, exc_info=True)
+            for sub in due:
+                store.record_failure(sub.chat_id, today)
+
+
+def _schedule_daily_push(app: Application) -> None:
+    if app.job_queue is None:
+        logging.warning("JobQueue is unavailable (install python-telegram-bot[job-queue]); daily push disabled")
+        return
+    app.job_queue.run_repeating(_daily_push_job, interval=60, first=10, name="daily_push")
+
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /subscribe [HH:MM] [xlsx|text|both]
+    send_at = get_env("DAILY_PUSH_AT", "09:00")
+    formats = "xlsx"
+    for arg in context.args or []:
+        if arg.lower() in SUBSCRIPTION_FORMATS:
+            formats = arg.lower()
+            continue
+        try:
+            send_at = datetime.strptime(arg, "%H:%M").strftime("%H:%M")
+        except ValueError:
+            await update.message.reply_text(
+                "Использование: /subscribe [ЧЧ:ММ] [xlsx|text|both], например /subscribe 08:30 both"
+            )
+            return
+    _get_subscriptions().subscribe(update.effective_chat.id, formats, send_at)
+    await update.message.reply_text(
+        f"Подписка оформлена: отчёт ДДС за вчера ежедневно в {send_at} "
+        f"({SUBSCRIPTION_FORMAT_LABELS[formats]}). Отменить — /unsubscribe"
+    )
+
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if _get_subscriptions().unsubscribe(update.effective_chat.id):
+        await update.message.reply_text("Подписка на ежедневный отчёт отменена.")
+    else:
+        await update.message.reply_text("Подписки на ежедневный отчёт нет.")
+
+
 # Безопасная отправка документов (XLSX) с повтором при таймауте
 
 
+# Фрагменты ответа Telegram на недействительный file_id
+_STALE_FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file", "file reference expired")
+
+
+def _is_stale_file_id(exc: BadRequest) -> bool:
+    message = str(exc).lower()
+    return any(fragment in message for fragment in _STALE_FILE_ID_ERRORS)
+
+
 async def safe_reply_document(
     message,
-    file_path: str,
+    report: ReportFile,
     caption: str | None = None,
     retries: int = 2,
     delay_base: float = 2.0,
 ) -> None:
-    for attempt in range(retries + 1):
+    # Уже загруженный файл с теми же данными отправляется по file_id — без повторной загрузки
+    index = _get_file_index() if report.fingerprint else None
+    file_id = index.get(report.kind, report.date_range, report.fingerprint) if index else None
+    attempt = 0
+    while True:
         try:
-            with open(file_path, "rb") as f:
-                await message.reply_document(
-                    document=InputFile(f, filename=os.path.basename(file_path)),
-                    caption=caption,
-                )
-            return
-        except TimedOut:
-            if attempt < retries:
-                await asyncio.sleep(delay_base * (attempt + 1))
-                continue
-            raise
-        except NetworkError:
+            # Файл отправляется из памяти; повторная попытка берёт те же байты
+            sent = await message.reply_document(
+                document=file_id or InputFile(report.content, filename=report.filename),
+                caption=caption,
+            )
+        except BadRequest as exc:
+            # Прочие BadRequest (чат не найден, неверная подпись) к файлу не относятся —
+            # file_id остаётся в индексе
+            if file_id is None or not _is_stale_file_id(exc):
+                raise
+            # file_id больше не действителен — загружаем файл заново
+            index.forget(report.kind, report.date_range, report.fingerprint)
+            file_id = None
+            continue
+        except (TimedOut, NetworkError):
             if attempt < retries:
-                await asyncio.sleep(delay_base * (attempt + 1))
+                attempt += 1
+                await asyncio.sleep(delay_base * attempt)
                 continue
             raise
+        if index is not None and file_id is None and sent is not None and sent.document is not None:
+            try:
+                index.put(report.kind, report.date_range, report.fingerprint, sent.document.file_id)
+            except Exception:
+                logging.warning("Failed to remember Telegram file_id for %s", report.filename, exc_info=True)
+        return
+
+
+# === Предварительное построение по расписанию (JobQueue) ===
+
+
+def _business_hours() -> Tuple[int, int]:
+    # PRERENDER_HOURS="9-23": часы работы, в которые обновляется отчёт за сегодня
+    start, _, end = get_env("PRERENDER_HOURS", "9-23").partition("-")
+    return int(start), int(end or 23)
+
+
+async def _prerender_day(iso_day: str) -> None:
+    token = _prerender_mode.set(True)
+    started = time.perf_counter()
+    try:
+        await _generate_xlsx_for_day(iso_day)
+        await _generate_text_info_for_day(iso_day)
+        logging.info("Pre-rendered reports for %s in %.2fs", iso_day, time.perf_counter() - started)
+    except Exception:
+        logging.warning("Pre-render for %s failed", iso_day, exc_info=True)
+    finally:
+        _prerender_mode.reset(token)
+
+
+async def _prerender_today_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    start, end = _business_hours()
+    if start <= datetime.now().hour <= end:
+        await _prerender_day(date.today().isoformat())
+
+
+async def _finalize_yesterday_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # День закрыт: срезы ложатся в снимки на диск, отчёты — в кэш отчётов.
+    # Срез вчерашнего дня мог попасть в кэш сразу после полуночи, ещё без поздних проводок, —
+    # поэтому он запрашивается заново и перезаписывает снимок
+    token = _olap_refresh.set(True)
+    try:
+        await _prerender_day((date.today() - timedelta(days=1)).isoformat())
+    finally:
+        _olap_refresh.reset(token)
+
+
+def _schedule_prerender(app: Application) -> None:
+    interval = _prerender_interval()
+    if interval <= 0:
+        return
+    if app.job_queue is None:
+        logging.warning("JobQueue is unavailable (install python-telegram-bot[job-queue]); pre-render disabled")
+        return
+    local_tz = datetime.now().astimezone().tzinfo
+    hour, _, minute = get_env("PRERENDER_FINALIZE_AT", "00:15").partition(":")
+    app.job_queue.run_repeating(_prerender_today_job, interval=interval, first=30, name="prerender_today")
+    app.job_queue.run_daily(
+        _finalize_yesterday_job,
+        time=dt_time(int(hour), int(minute or 0), tzinfo=local_tz),
+        name="finalize_yesterday",
+    )
+
+
+async def _log_report_stats_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Периодическая сводка: глубина очереди и ожидание в пуле, попадания в кэши
+    if _report_scheduler is not None:
+        logging.info("Report scheduler stats: %s", _report_scheduler.stats())
+    if _olap_cache is not None:
+        logging.info("OLAP cache stats: %s", _olap_cache.stats())
+    if _report_cache is not None:
+        logging.info("Report cache stats: %s", _report_cache.stats())
+
+
+def _schedule_stats_logging(app: Application) -> None:
+    interval = float(get_env("STATS_LOG_INTERVAL_MIN", "15")) * 60
+    if interval <= 0 or app.job_queue is None:
+        return
+    app.job_queue.run_repeating(_log_report_stats_job, interval=interval, first=interval, name="report_stats")
+
+
+_warmup_task: Optional["asyncio.Task[None]"] = None
+
+
+async def _on_startup(app: Application) -> None:
+    global _warmup_task
+    logging.info("Bot ready in %.2fs", time.perf_counter() - _BOOT_STARTED)
+    # Прогрев pandas/openpyxl в фоне: первый отчёт не ждёт импорта, а меню доступно уже сейчас
+    if get_env("REPORT_WARMUP", "1") != "0":
+        if _use_process_pool():
+            # Процессы пула стартуют заранее и импортируют pandas/openpyxl в инициализаторе
+            _warmup_task = asyncio.get_running_loop().create_task(_get_report_scheduler().prestart())
+        else:
+            _warmup_task = asyncio.get_running_loop().create_task(asyncio.to_thread(report_worker.warm_up))
+
+
+async def _on_shutdown(app: Application) -> None:
+    # Logout освобождает лицензионное место iiko
+    await aclose_shared_async_clients()
+    if _report_scheduler is not None:
+        logging.info("Report scheduler stats: %s", _report_scheduler.stats())
+        await _report_scheduler.close()
+    if _olap_cache is not None:
+        logging.info("OLAP cache stats: %s", _olap_cache.stats())
+        if _olap_cache.store is not None:
+            _olap_cache.store.close()
+    if _report_cache is not None:
+        logging.info("Report cache stats: %s", _report_cache.stats())
+    if _file_index is not None:
+        _file_index.close()
+    if _subscriptions is not None:
+        _subscriptions.close()
 
 
 def main() -> None:
     load_dotenv()
+    logging.basicConfig(
+        level=get_env("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    # httpx на INFO пишет каждый запрос вместе с токеном бота в URL
+    logging.getLogger("httpx").setLevel(logging.WARNING)
     token = get_env("TELEGRAM_BOT_TOKEN")
     # Настраиваем увеличенные таймауты HTTPXRequest для предотвращения TimedOut
     http_request = HTTPXRequest(
@@ -413,10 +1007,22 @@ def main() -> None:
         media_write_timeout=120.0,
     )
 
-    app = Application.builder().token(token).request(http_request).build()
+    app = (
+        Application.builder()
+        .token(token)
+        .request(http_request)
+        .post_init(_on_startup)
+        .post_shutdown(_on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start_command))
+    app.add_handler(CommandHandler("subscribe", subscribe_command))
+    app.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
     app.add_handler(CallbackQueryHandler(_on_callback))
+    _schedule_prerender(app)
+    _schedule_daily_push(app)
+    _schedule_stats_logging(app)
 
     print("Bot is running... Use Ctrl+C to stop.")
     app.run_polling()
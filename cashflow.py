@@ -1,7 +1,10 @@
+import io
 import os
 import logging
+from itertools import repeat
+import numpy as np
 import pandas as pd
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 
 RU_ACCOUNT_MAIN = "Главная касса"
@@ -14,6 +17,35 @@ ACCOUNT_NAME_MAP = {
     RU_ACCOUNT_TRADES: RU_ACCOUNT_TRADES,
 }
 
+DAY_FIELD = "DateTime.DateTyped"
+
+# Ответ OLAP (JSON) или уже развёрнутый кадр, например день из split_olap_by_day
+OlapData = Union[Dict[str, Any], pd.DataFrame]
+
+NUMERIC_COLS = [
+    "Sum.Incoming",
+    "Sum.Outgoing",
+    "FinalBalance.Money",
+    "StartBalance.Money",
+]
+META_COLS = [
+    "CashFlowCategory.HierarchyLevel1",
+    "CashFlowCategory.HierarchyLevel2",
+    "CashFlowCategory.HierarchyLevel3",
+    "CashFlowCategory.Type",
+]
+# Метка в DataFrame.attrs: кадр уже прошёл ingest_olap
+CANONICAL_ATTR = "cashflow_canonical"
+
+# Компактная схема канонического кадра: измерения — категории, суммы — копейки int64.
+# Остальные поля ответа iiko (включая исходный Account.Name) отбрасываются;
+# DateTime.DateTyped сохраняется (как категория YYYY-MM-DD) только если пришёл в ответе.
+CANONICAL_SCHEMA = {
+    "AccountNorm": "category",
+    **{col: "category" for col in META_COLS},
+    **{col: "int64" for col in NUMERIC_COLS},
+}
+
 CATEGORY_RU_MAP = {
     # Common English -> Russian mappings
     "Internal transfer": "Внутреннее перемещение",
@@ -28,63 +60,169 @@ CATEGORY_RU_MAP = {
 }
 
 
+def _olap_frame(raw: OlapData) -> pd.DataFrame:
+    if isinstance(raw, pd.DataFrame):
+        return raw
+    return pd.json_normalize(raw.get("data", []))
+
+
+def split_olap_by_day(raw_json: Dict[str, Any], days: Optional[Iterable[str]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Делит многодневный ответ OLAP (с группировкой по DateTime.DateTyped) на кадры по дням.
+
+    Ответ проходит ingest_olap один раз, кадры дней уже канонические.
+    Ключи — даты в ISO-формате. Для дней из ``days`` без данных возвращается пустой кадр.
+    """
+    df = ingest_olap(raw_json)
+    frames: Dict[str, pd.DataFrame] = {}
+    if DAY_FIELD in df.columns and not df.empty:
+        for day, part in df.groupby(DAY_FIELD, observed=True, sort=True):
+            frames[str(day)] = part.drop(columns=[DAY_FIELD]).reset_index(drop=True)
+    for day in days or ():
+        frames.setdefault(day, df.drop(columns=[DAY_FIELD], errors="ignore").iloc[0:0])
+    return frames
+
+
+# Кэш соответствий "имя счёта iiko -> касса" между вызовами (имён единицы, строк — тысячи)
+_ACCOUNT_NORM_CACHE: Dict[Any, Optional[str]] = {}
+ACCOUNT_CATEGORIES = [RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]
+
+
+def _canonical_account(val: Any) -> Optional[str]:
+    try:
+        s = str(val or "").strip().lower()
+    except Exception:
+        s = ""
+    if not s:
+        return None
+    # Robust matching for Russian and English variants, ignoring suffixes/prefixes
+    if ("главная касс" in s) or ("main cash register" in s):
+        return RU_ACCOUNT_MAIN
+    if ("торгов" in s) or ("trade cash register" in s) or ("trade cash registers" in s):
+        return RU_ACCOUNT_TRADES
+    # Fallback to direct map if exact key exists
+    return ACCOUNT_NAME_MAP.get(val)
+
+
+def _account_code(val: Any) -> int:
+    """Код кассы в ACCOUNT_CATEGORIES (-1 — счёт не относится к отчёту), с кэшем."""
+    try:
+        norm = _ACCOUNT_NORM_CACHE[val]
+    except (KeyError, TypeError):
+        norm = _canonical_account(val)
+        try:
+            _ACCOUNT_NORM_CACHE[val] = norm
+        except TypeError:
+            pass
+    return ACCOUNT_CATEGORIES.index(norm) if norm in ACCOUNT_CATEGORIES else -1
+
+
 def _normalize_accounts(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
+    """
+    Оставляет строки двух касс и добавляет категориальный столбец AccountNorm.
+
+    Сопоставление считается только для уникальных имён счетов; исходный кадр не изменяется.
+    """
     if "Account.Name" not in df.columns:
         # Nothing to normalize
-        df["AccountNorm"] = None
-        return df[df["AccountNorm"].isin({RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES})]
+        out = df.iloc[0:0].copy()
+        out["AccountNorm"] = pd.Categorical([], categories=ACCOUNT_CATEGORIES)
+        return out
 
-    def map_name(val: Any) -> Any:
-        try:
-            s = str(val or "").strip().lower()
-        except Exception:
-            s = ""
-        if not s:
-            return None
-        # Robust matching for Russian and English variants, ignoring suffixes/prefixes
-        if ("главная касс" in s) or ("main cash register" in s):
-            return RU_ACCOUNT_MAIN
-        if ("торгов" in s) or ("trade cash register" in s) or ("trade cash registers" in s):
-            return RU_ACCOUNT_TRADES
-        # Fallback to direct map if exact key exists
-        return ACCOUNT_NAME_MAP.get(val)
-
-    df["AccountNorm"] = df["Account.Name"].map(map_name)
+    row_codes, uniques = pd.factorize(df["Account.Name"], use_na_sentinel=True)
+    # Последний элемент (-1) соответствует пустым именам
+    unique_codes = np.array([_account_code(u) for u in uniques] + [-1], dtype=np.int8)
+    codes = unique_codes[row_codes]
+    keep = codes >= 0
 
     # Diagnostics: log unique names and mapping coverage
-    try:
-        src_names = sorted(set(str(x) for x in df["Account.Name"].dropna().unique().tolist()))
-        norm_names = sorted(set(str(x) for x in df["AccountNorm"].dropna().unique().tolist()))
-        logging.info("[cashflow] Account.Name uniques: %s", src_names)
-        logging.info("[cashflow] AccountNorm uniques: %s", norm_names)
-        logging.info("[cashflow] rows before norm: %d, after norm: %d", len(df), len(df[df["AccountNorm"].isin({RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES})]))
-    except Exception:
-        pass
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("[cashflow] Account.Name uniques: %s", sorted(str(x) for x in uniques))
+        logging.debug(
+            "[cashflow] AccountNorm uniques: %s",
+            sorted({ACCOUNT_CATEGORIES[c] for c in unique_codes if c >= 0}),
+        )
+        logging.debug("[cashflow] rows before norm: %d, after norm: %d", len(df), int(keep.sum()))
+
+    out = df.take(np.flatnonzero(keep))
+    out["AccountNorm"] = pd.Categorical.from_codes(codes[keep], categories=ACCOUNT_CATEGORIES)
+    return out
+
+
+def kopecks_to_rubles(value: Any) -> Any:
+    """Копейки -> рубли для вывода; нечисловые значения (пустые ячейки) без изменений."""
+    if isinstance(value, (int, np.integer)):
+        return int(value) / 100
+    if isinstance(value, (float, np.floating)):
+        return float(value) / 100
+    return value
+
+
+def format_rubles(kopecks: Any) -> str:
+    """Сумма в копейках как '1,234.56' — точно, без промежуточного float."""
+    k = int(kopecks or 0)
+    sign = "-" if k < 0 else ""
+    rub, kop = divmod(abs(k), 100)
+    return f"{sign}{rub:,}.{kop:02d}"
+
+
+def _rubles_columns(table: pd.DataFrame, cols: Iterable[str]) -> pd.DataFrame:
+    for col in cols:
+        table[col] = table[col] / 100
+    return table
 
-    df = df[df["AccountNorm"].isin({RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES})]
-    return df
 
+def _is_canonical(df: pd.DataFrame) -> bool:
+    """Кадр уже прошёл ingest_olap: по метке в attrs или по столбцам схемы (attrs теряются, например, при merge)."""
+    if df.attrs.get(CANONICAL_ATTR):
+        return True
+    return "Account.Name" not in df.columns and all(col in df.columns for col in CANONICAL_SCHEMA)
 
-def build_cashflow_tables(raw_json: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    raw = raw_json.get("data", [])
-    df = pd.json_normalize(raw)
 
-    df = _normalize_accounts(df)
+def ingest_olap(raw: OlapData) -> pd.DataFrame:
+    """
+    Приводит ответ OLAP к каноническому кадру, с которым работают все построители.
+
+    Разворачивает JSON, нормализует кассы (AccountNorm — категориальный столбец),
+    сводит синонимы статей 1-го уровня через CATEGORY_RU_MAP, добавляет
+    недостающие столбцы и переводит суммы в целые копейки (int64). Результат
+    следует CANONICAL_SCHEMA, лишние поля отбрасываются. Выполняется один раз:
+    уже канонический кадр (см. _is_canonical) возвращается как есть, поэтому текст и
+    XLSX за один день можно строить из одного результата. Кадр не изменяется построителями.
+    DataFrame без Account.Name и без столбцов схемы — ошибка (ValueError), а не пустой отчёт.
+    """
+    if isinstance(raw, pd.DataFrame):
+        if _is_canonical(raw):
+            return raw
+        if "Account.Name" not in raw.columns:
+            raise ValueError(
+                "OLAP frame has neither Account.Name nor the canonical columns; "
+                f"got {list(raw.columns)}"
+            )
+    src = _normalize_accounts(_olap_frame(raw))
+    columns: Dict[str, Any] = {"AccountNorm": src["AccountNorm"].array}
+    for col in META_COLS:
+        values = src[col] if col in src.columns else pd.Series(None, index=src.index, dtype=object)
+        if col == "CashFlowCategory.HierarchyLevel1":
+            # Синонимы статей (англ./рус.) сводятся к русскому названию один раз
+            values = values.map(CATEGORY_RU_MAP).fillna(values)
+        columns[col] = values.astype("category").array
+    # Деньги — целые копейки (int64): суммы и итоги считаются без накопления ошибок округления
+    for col in NUMERIC_COLS:
+        if col in src.columns:
+            rubles = pd.to_numeric(src[col], errors="coerce").fillna(0.0).to_numpy(dtype="float64")
+            columns[col] = np.round(rubles * 100).astype("int64")
+        else:
+            columns[col] = np.zeros(len(src), dtype="int64")
+    if DAY_FIELD in src.columns:
+        columns[DAY_FIELD] = src[DAY_FIELD].astype(str).str.slice(0, 10).astype("category").array
+    df = pd.DataFrame(columns)
+    df.attrs[CANONICAL_ATTR] = True
+    return df
 
-    # Ensure required columns exist
-    for col in [
-        "Sum.Incoming",
-        "Sum.Outgoing",
-        "FinalBalance.Money",
-        "StartBalance.Money",
-        "CashFlowCategory.HierarchyLevel1",
-        "CashFlowCategory.HierarchyLevel2",
-        "CashFlowCategory.HierarchyLevel3",
-        "CashFlowCategory.Type",
-    ]:
-        if col not in df.columns:
-            df[col] = 0
+
+def build_cashflow_tables(raw_json: OlapData) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    df = ingest_olap(raw_json)
 
     cat_col = "CashFlowCategory.HierarchyLevel1"
     type_col = "CashFlowCategory.Type"
@@ -97,18 +235,18 @@ def build_cashflow_tables(raw_json: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.Da
 
     # 1) Остаток на начало (из строк без категории: StartBalance.Money)
     start_bal = (
-        balances_df.groupby("AccountNorm")["StartBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
+        balances_df.groupby("AccountNorm", observed=True)["StartBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
     )
     start_row = pd.DataFrame([start_bal.values], index=["Остаток на начало"], columns=[RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES])
 
     # 2) Обороты по категориям и типам: приход и расход отдельно
     incoming = (
-        flows_df.groupby([type_col, cat_col, "AccountNorm"])  # type: ignore
+        flows_df.groupby([type_col, cat_col, "AccountNorm"], observed=True)  # type: ignore
         ["Sum.Incoming"].sum(min_count=1)
         .unstack(fill_value=0)
     )
     outgoing = (
-        flows_df.groupby([type_col, cat_col, "AccountNorm"])  # type: ignore
+        flows_df.groupby([type_col, cat_col, "AccountNorm"], observed=True)  # type: ignore
         ["Sum.Outgoing"].sum(min_count=1)
         .unstack(fill_value=0)
     )
@@ -129,7 +267,7 @@ def build_cashflow_tables(raw_json: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.Da
 
     # 3) Остаток на конец (из строк без категории: FinalBalance.Money)
     end_bal = (
-        balances_df.groupby("AccountNorm")["FinalBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
+        balances_df.groupby("AccountNorm", observed=True)["FinalBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
     )
     end_row = pd.DataFrame([end_bal.values], index=["Остаток на конец"], columns=[RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES])
 
@@ -218,28 +356,11 @@ def build_cashflow_tables(raw_json: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.Da
     # Add total column
     result["Итого"] = result[[RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]].sum(axis=1)
 
-    return result, df
-
-
-def build_cashflow_detailed_table(raw_json: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    raw = raw_json.get("data", [])
-    df = pd.json_normalize(raw)
+    return _rubles_columns(result, [RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES, "Итого"]), df
 
-    df = _normalize_accounts(df)
 
-    # Ensure required columns exist
-    for col in [
-        "Sum.Incoming",
-        "Sum.Outgoing",
-        "FinalBalance.Money",
-        "StartBalance.Money",
-        "CashFlowCategory.HierarchyLevel1",
-        "CashFlowCategory.HierarchyLevel2",
-        "CashFlowCategory.HierarchyLevel3",
-        "CashFlowCategory.Type",
-    ]:
-        if col not in df.columns:
-            df[col] = 0
+def build_cashflow_detailed_table(raw_json: OlapData) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    df = ingest_olap(raw_json)
 
     cat_col = "CashFlowCategory.HierarchyLevel1"
     type_col = "CashFlowCategory.Type"
@@ -253,17 +374,17 @@ def build_cashflow_detailed_table(raw_json: Dict[str, Any]) -> Tuple[pd.DataFram
 
     # Остаток на начало
     start_bal = (
-        balances_df.groupby("AccountNorm")["StartBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
+        balances_df.groupby("AccountNorm", observed=True)["StartBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
     )
 
     # Разбивка по категориям: приход и расход отдельно
     incoming = (
-        flows_df.groupby([type_col, cat_col, "AccountNorm"])  # type: ignore
+        flows_df.groupby([type_col, cat_col, "AccountNorm"], observed=True)  # type: ignore
         ["Sum.Incoming"].sum(min_count=1)
         .unstack(fill_value=0)
     )
     outgoing = (
-        flows_df.groupby([type_col, cat_col, "AccountNorm"])  # type: ignore
+        flows_df.groupby([type_col, cat_col, "AccountNorm"], observed=True)  # type: ignore
         ["Sum.Outgoing"].sum(min_count=1)
         .unstack(fill_value=0)
     )
@@ -336,7 +457,7 @@ def build_cashflow_detailed_table(raw_json: Dict[str, Any]) -> Tuple[pd.DataFram
 
     # Остаток на конец
     end_bal = (
-        balances_df.groupby("AccountNorm")["FinalBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
+        balances_df.groupby("AccountNorm", observed=True)["FinalBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
     )
     add_row("Остаток на конец", main_val=float(end_bal.get(RU_ACCOUNT_MAIN, 0)), trade_val=float(end_bal.get(RU_ACCOUNT_TRADES, 0)))
 
@@ -351,31 +472,31 @@ def build_cashflow_detailed_table(raw_json: Dict[str, Any]) -> Tuple[pd.DataFram
         "Итого",
     ])
 
-    return detailed, df
+    return _rubles_columns(detailed, [RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES, "Итого"]), df
 
 
 def calculate_daily_movement(current: pd.DataFrame, previous: pd.DataFrame, account: str, type_col: str, cat_col: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """Calculate incoming and outgoing movements for the day by comparing current and previous data."""
     # Current day totals
     curr_incoming = (
-        current.groupby([type_col, cat_col, "AccountNorm"])["Sum.Incoming"]  # type: ignore
+        current.groupby([type_col, cat_col, "AccountNorm"], observed=True)["Sum.Incoming"]  # type: ignore
         .sum(min_count=1)
         .unstack(fill_value=0)
     )
     curr_outgoing = (
-        current.groupby([type_col, cat_col, "AccountNorm"])["Sum.Outgoing"]  # type: ignore
+        current.groupby([type_col, cat_col, "AccountNorm"], observed=True)["Sum.Outgoing"]  # type: ignore
         .sum(min_count=1)
         .unstack(fill_value=0)
     )
 
     # Previous day totals
     prev_incoming = (
-        previous.groupby([type_col, cat_col, "AccountNorm"])["Sum.Incoming"]  # type: ignore
+        previous.groupby([type_col, cat_col, "AccountNorm"], observed=True)["Sum.Incoming"]  # type: ignore
         .sum(min_count=1)
         .unstack(fill_value=0)
     )
     prev_outgoing = (
-        previous.groupby([type_col, cat_col, "AccountNorm"])["Sum.Outgoing"]  # type: ignore
+        previous.groupby([type_col, cat_col, "AccountNorm"], observed=True)["Sum.Outgoing"]  # type: ignore
         .sum(min_count=1)
         .unstack(fill_value=0)
     )
@@ -387,26 +508,9 @@ def calculate_daily_movement(current: pd.DataFrame, previous: pd.DataFrame, acco
     return daily_incoming, daily_outgoing
 
 
-def build_cashflow_tables_for_day(raw_json_day: Dict[str, Any], raw_json_prev: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    day = pd.json_normalize(raw_json_day.get("data", []))
-    prev = pd.json_normalize(raw_json_prev.get("data", []))
-
-    day = _normalize_accounts(day)
-    prev = _normalize_accounts(prev)
-
-    for df in (day, prev):
-        for col in [
-            "Sum.Incoming",
-            "Sum.Outgoing",
-            "FinalBalance.Money",
-            "StartBalance.Money",
-            "CashFlowCategory.HierarchyLevel1",
-            "CashFlowCategory.HierarchyLevel2",
-            "CashFlowCategory.HierarchyLevel3",
-            "CashFlowCategory.Type",
-        ]:
-            if col not in df.columns:
-                df[col] = 0
+def build_cashflow_tables_for_day(raw_json_day: OlapData, raw_json_prev: OlapData) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    day = ingest_olap(raw_json_day)
+    prev = ingest_olap(raw_json_prev)
 
     cat_col = "CashFlowCategory.HierarchyLevel1"
     type_col = "CashFlowCategory.Type"
@@ -414,7 +518,7 @@ def build_cashflow_tables_for_day(raw_json_day: Dict[str, Any], raw_json_prev: D
     # Start balance at beginning of day: previous day's final balances (no category)
     prev_balances = prev[prev[cat_col].isna()]
     start_bal = (
-        prev_balances.groupby("AccountNorm")["FinalBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
+        prev_balances.groupby("AccountNorm", observed=True)["FinalBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
     )
 
     # Day flows (include all types)
@@ -534,36 +638,19 @@ def build_cashflow_tables_for_day(raw_json_day: Dict[str, Any], raw_json_prev: D
     # Add total column
     result["Итого"] = result[[RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]].sum(axis=1)
 
-    return result, day
+    return _rubles_columns(result, [RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES, "Итого"]), day
 
 
-def build_cashflow_detailed_table_for_day(raw_json_day: Dict[str, Any], raw_json_prev: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    day = pd.json_normalize(raw_json_day.get("data", []))
-    prev = pd.json_normalize(raw_json_prev.get("data", []))
-
-    day = _normalize_accounts(day)
-    prev = _normalize_accounts(prev)
-
-    for df in (day, prev):
-        for col in [
-            "Sum.Incoming",
-            "Sum.Outgoing",
-            "FinalBalance.Money",
-            "StartBalance.Money",
-            "CashFlowCategory.HierarchyLevel1",
-            "CashFlowCategory.HierarchyLevel2",
-            "CashFlowCategory.HierarchyLevel3",
-            "CashFlowCategory.Type",
-        ]:
-            if col not in df.columns:
-                df[col] = 0
+def build_cashflow_detailed_table_for_day(raw_json_day: OlapData, raw_json_prev: OlapData) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    day = ingest_olap(raw_json_day)
+    prev = ingest_olap(raw_json_prev)
 
     cat_col = "CashFlowCategory.HierarchyLevel1"
     type_col = "CashFlowCategory.Type"
 
     prev_balances = prev[prev[cat_col].isna()] if prev[cat_col].isna().any() else prev[prev[cat_col] == None]
     start_bal = (
-        prev_balances.groupby("AccountNorm")["FinalBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
+        prev_balances.groupby("AccountNorm", observed=True)["FinalBalance.Money"].sum().reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES]).fillna(0)
     )
 
     flows_mask = day[cat_col].notna()
@@ -571,12 +658,12 @@ def build_cashflow_detailed_table_for_day(raw_json_day: Dict[str, Any], raw_json
     flows_day = day[flows_mask]
 
     incoming = (
-        flows_day.groupby([type_col, cat_col, "AccountNorm"])  # type: ignore
+        flows_day.groupby([type_col, cat_col, "AccountNorm"], observed=True)  # type: ignore
         ["Sum.Incoming"].sum(min_count=1)
         .unstack(fill_value=0)
     )
     outgoing = (
-        flows_day.groupby([type_col, cat_col, "AccountNorm"])  # type: ignore
+        flows_day.groupby([type_col, cat_col, "AccountNorm"], observed=True)  # type: ignore
         ["Sum.Outgoing"].sum(min_count=1)
         .unstack(fill_value=0)
     )
@@ -649,7 +736,7 @@ def build_cashflow_detailed_table_for_day(raw_json_day: Dict[str, Any], raw_json
                             trade_val=-float(cat_outgoing.get(RU_ACCOUNT_TRADES, 0)))
 
     net_by_acc = (
-        flows_day.groupby("AccountNorm").apply(lambda x: (x["Sum.Incoming"].fillna(0) - x["Sum.Outgoing"].fillna(0)).sum())
+        flows_day.groupby("AccountNorm", observed=True).apply(lambda x: (x["Sum.Incoming"].fillna(0) - x["Sum.Outgoing"].fillna(0)).sum())
         .reindex([RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES])
         .fillna(0)
     )
@@ -667,7 +754,7 @@ def build_cashflow_detailed_table_for_day(raw_json_day: Dict[str, Any], raw_json
         "Итого",
     ])
 
-    return detailed, day
+    return _rubles_columns(detailed, [RU_ACCOUNT_MAIN, RU_ACCOUNT_TRADES, "Итого"]), day
 
 
 def export_to_excel(result: pd.DataFrame, path: str = "cashflow_pivot.xlsx") -> str:
@@ -699,7 +786,292 @@ def dataframe_to_text_table(df: pd.DataFrame, max_rows: int = 30) -> str:
 
 
 # --- Excel mapping: JSON_previous + JSON_current -> Excel cashflow layout ---
-def build_excel_cashflow_table(json_prev: Dict[str, Any], json_curr: Dict[str, Any]) -> pd.DataFrame:
+CATEGORY_MEASURES = ["prev_fb", "curr_fb", "curr_in", "curr_out"]
+
+
+def _aggregate_category_measures(prev: pd.DataFrame, curr: pd.DataFrame) -> pd.DataFrame:
+    """
+    Все показатели по (касса, статья 1-го уровня) одной группировкой.
+
+    Колонки (копейки, int64): prev_fb / curr_fb — FinalBalance.Money предыдущего и
+    текущего среза, curr_in / curr_out — приход и расход текущего среза. Синонимы статей уже
+    сведены в ingest_olap, поэтому ключ — русское название статьи.
+    """
+    key_cols = ["AccountNorm", "CashFlowCategory.HierarchyLevel1"]
+    prev_cat = prev.loc[prev["CashFlowCategory.HierarchyLevel1"].notna(), key_cols + ["FinalBalance.Money"]]
+    curr_cat = curr.loc[
+        curr["CashFlowCategory.HierarchyLevel1"].notna(),
+        key_cols + ["FinalBalance.Money", "Sum.Incoming", "Sum.Outgoing"],
+    ]
+    # Общие категории статей, чтобы concat сохранил категориальный тип и группировка шла по кодам
+    l1_categories = prev_cat["CashFlowCategory.HierarchyLevel1"].cat.categories.union(
+        curr_cat["CashFlowCategory.HierarchyLevel1"].cat.categories
+    )
+    prev_cat = prev_cat.assign(**{
+        "CashFlowCategory.HierarchyLevel1": prev_cat["CashFlowCategory.HierarchyLevel1"].cat.set_categories(l1_categories)
+    })
+    curr_cat = curr_cat.assign(**{
+        "CashFlowCategory.HierarchyLevel1": curr_cat["CashFlowCategory.HierarchyLevel1"].cat.set_categories(l1_categories)
+    })
+    out_cols = key_cols + CATEGORY_MEASURES
+    combined = pd.concat(
+        [
+            prev_cat.rename(columns={"FinalBalance.Money": "prev_fb"}).reindex(columns=out_cols, fill_value=0),
+            curr_cat.rename(columns={
+                "FinalBalance.Money": "curr_fb",
+                "Sum.Incoming": "curr_in",
+                "Sum.Outgoing": "curr_out",
+            }).reindex(columns=out_cols, fill_value=0),
+        ],
+        ignore_index=True,
+    )
+    return combined.groupby(key_cols, observed=True)[CATEGORY_MEASURES].sum()
+
+# --- Declarative Excel layout (rows 9-18) ---
+class LayoutRow(NamedTuple):
+    """
+    Строка макета Excel.
+
+    main / trades — источники колонок кассы (начало, приход, расход, конец): имя
+    показателя из CATEGORY_MEASURES по статье l1, "start_balance"/"end_balance" для
+    общих остатков или None (ноль). total_of — ключи строк, сумма которых образует
+    итоговую строку (источники касс при этом не задаются).
+    """
+    key: str
+    type_label: str
+    l1: Optional[str] = None
+    main: Tuple[Optional[str], ...] = (None, None, None, None)
+    trades: Tuple[Optional[str], ...] = (None, None, None, None)
+    total_of: Tuple[str, ...] = ()
+
+
+class CompiledLayout(NamedTuple):
+    rows: Tuple[LayoutRow, ...]
+    # (касса, статья, показатель) для каждого источника; индекс 0 — константа ноль
+    sources: Tuple[Tuple[str, str, str], ...]
+    # (строки, 8): индексы источников для колонок главной (4) и торговых (4) касс
+    gather: np.ndarray
+    # (строки, строки): каждая строка — взвешенная сумма строк-источников
+    weights: np.ndarray
+    # Позиции источников-показателей по статьям и их ключи для reindex агрегатов
+    category_pos: np.ndarray
+    category_keys: pd.MultiIndex
+    # Позиции источников-остатков: (позиция, касса, "start_balance" | "end_balance")
+    balance_sources: Tuple[Tuple[int, str, str], ...]
+
+
+BALANCE_MEASURES = ("start_balance", "end_balance")
+_BALANCES_ONLY = ("prev_fb", None, None, "curr_fb")
+
+EXCEL_LAYOUT: Tuple[LayoutRow, ...] = (
+    LayoutRow(
+        "balances", "Общие остатки по кассам",
+        main=("start_balance", None, None, "end_balance"),
+        trades=("start_balance", None, None, "end_balance"),
+    ),
+    LayoutRow(
+        "op_transfer", "Операционная деятельность", "Внутреннее перемещение",
+        main=("prev_fb", "curr_in", None, "curr_fb"),
+        trades=("prev_fb", None, "curr_out", "curr_fb"),
+    ),
+    LayoutRow("op_revenue", "", "Выручка", trades=("prev_fb", "curr_in", None, "curr_fb")),
+    LayoutRow("op_invoices", "", "Оплата накладных", main=_BALANCES_ONLY, trades=_BALANCES_ONLY),
+    LayoutRow("op_salary", "", "Оплата труда", main=_BALANCES_ONLY),
+    LayoutRow("op_advance", "", "Подотчет", main=("prev_fb", None, "curr_out", "curr_fb"), trades=_BALANCES_ONLY),
+    LayoutRow("op_prepayment", "", "Предоплата", trades=_BALANCES_ONLY),
+    LayoutRow(
+        "op_total", "Операционная деятельность всего",
+        total_of=("op_transfer", "op_revenue", "op_invoices", "op_salary", "op_advance", "op_prepayment"),
+    ),
+    LayoutRow("fin_loan", "Финансовая деятельность", "Займ", main=_BALANCES_ONLY),
+    LayoutRow("total", "Итого", total_of=("balances", "op_total", "fin_loan")),
+)
+
+
+def compile_layout(layout: Tuple[LayoutRow, ...]) -> CompiledLayout:
+    """Переводит макет в индексы источников и матрицу сумм (выполняется один раз)."""
+    sources: List[Tuple[str, str, str]] = [("", "", "")]
+    source_index: Dict[Tuple[str, str, str], int] = {}
+    row_index: Dict[str, int] = {}
+    gather = np.zeros((len(layout), 8), dtype=np.intp)
+    weights = np.zeros((len(layout), len(layout)), dtype=np.int64)
+    for i, row in enumerate(layout):
+        if row.key in row_index:
+            raise ValueError(f"Duplicate layout row key: {row.key}")
+        row_index[row.key] = i
+        if row.total_of:
+            for member in row.total_of:
+                if member not in row_index:
+                    raise ValueError(f"Layout total {row.key} refers to unknown or later row {member}")
+                weights[i] += weights[row_index[member]]
+            continue
+        weights[i, i] = 1
+        for offset, (account, measures) in enumerate(((RU_ACCOUNT_MAIN, row.main), (RU_ACCOUNT_TRADES, row.trades))):
+            for j, measure in enumerate(measures):
+                if measure is None:
+                    continue
+                key = (account, "" if measure in BALANCE_MEASURES else (row.l1 or ""), measure)
+                if key not in source_index:
+                    source_index[key] = len(sources)
+                    sources.append(key)
+                gather[i, offset * 4 + j] = source_index[key]
+    category_pos = [i for i, key in enumerate(sources) if i and key[2] not in BALANCE_MEASURES]
+    balance_sources = tuple((i, key[0], key[2]) for i, key in enumerate(sources) if key[2] in BALANCE_MEASURES)
+    return CompiledLayout(
+        rows=tuple(layout),
+        sources=tuple(sources),
+        gather=gather,
+        weights=weights,
+        category_pos=np.array(category_pos, dtype=np.intp),
+        category_keys=pd.MultiIndex.from_tuples([sources[i] for i in category_pos]),
+        balance_sources=balance_sources,
+    )
+
+
+def evaluate_layout(compiled: CompiledLayout, sources: np.ndarray) -> np.ndarray:
+    """
+    Значения колонок касс для всех строк макета.
+
+    sources — вектор источников (или матрица: дни x источники); результат имеет
+    форму (..., строки, 8): главная касса (начало, приход, расход, конец), затем торговые.
+    """
+    leaf = sources[..., compiled.gather]
+    return np.einsum("rk,...kc->...rc", compiled.weights.astype(leaf.dtype), leaf)
+
+
+def _layout_sources(
+    compiled: CompiledLayout,
+    measures: pd.DataFrame,
+    start_by_acc: pd.Series,
+    end_by_acc: pd.Series,
+) -> np.ndarray:
+    """Вектор источников макета (копейки) из агрегатов по статьям и остатков по кассам."""
+    values = np.zeros(len(compiled.sources), dtype=np.int64)
+    if not measures.empty and len(compiled.category_pos):
+        picked = measures.stack().reindex(compiled.category_keys, fill_value=0)
+        values[compiled.category_pos] = picked.to_numpy(dtype=np.int64)
+    balances = {"start_balance": start_by_acc, "end_balance": end_by_acc}
+    for pos, account, measure in compiled.balance_sources:
+        values[pos] = int(balances[measure].get(account, 0) or 0)
+    return values
+
+
+def _layout_table(compiled: CompiledLayout, values: np.ndarray) -> pd.DataFrame:
+    """Таблица A-R по вычисленному макету (значения одной даты, копейки int64)."""
+    table = pd.DataFrame({
+        "Тип статьи ДДС": [row.type_label for row in compiled.rows],
+        "Статья ДДС 1-го уровня": [row.l1 or "" for row in compiled.rows],
+        "Статья ДДС 2-го уровня": "",
+        "Статья ДДС 3-го уровня": "",
+    })
+    main, trades = values[:, :4], values[:, 4:]
+    total = main + trades
+    for letters, block in (("EGHI", main), ("JLMN", trades), ("OPQR", total)):
+        for j, letter in enumerate(letters):
+            table[letter] = block[:, j]
+    table["F"] = ""
+    table["K"] = ""
+    # Final DataFrame in display order: A-D then E-R
+    return table[[
+        "Тип статьи ДДС",
+        "Статья ДДС 1-го уровня",
+        "Статья ДДС 2-го уровня",
+        "Статья ДДС 3-го уровня",
+        "E", "F", "G", "H", "I",
+        "J", "K", "L", "M", "N",
+        "O", "P", "Q", "R",
+    ]]
+
+
+EXCEL_LAYOUT_COMPILED = compile_layout(EXCEL_LAYOUT)
+
+
+# --- Small payloads: aggregation over plain dicts, without DataFrame construction ---
+# Ответ за день по двум кассам — десятки строк; на таком объёме json_normalize и groupby
+# стоят дороже самих данных. Выше порога используется путь через pandas.
+FAST_PATH_MAX_ROWS = 1000
+
+
+def _olap_rows(raw: OlapData) -> Optional[List[Dict[str, Any]]]:
+    """Строки JSON-ответа OLAP для быстрого пути; None — путь через pandas."""
+    if not isinstance(raw, dict):
+        return None
+    rows = raw.get("data") or []
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        return None
+    return rows
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def _to_kopecks(value: Any) -> int:
+    """Как pd.to_numeric(errors="coerce").fillna(0) и округление до копеек в ingest_olap."""
+    if isinstance(value, bool):
+        value = int(value)
+    try:
+        rubles = float(value)
+    except (TypeError, ValueError):
+        return 0
+    if rubles != rubles:
+        return 0
+    return int(round(rubles * 100))
+
+
+def _small_layout_sources(
+    compiled: CompiledLayout,
+    rows_prev: List[Dict[str, Any]],
+    rows_curr: List[Dict[str, Any]],
+) -> np.ndarray:
+    """Вектор источников макета за один проход по строкам, без pandas (копейки)."""
+    l1_col = "CashFlowCategory.HierarchyLevel1"
+    measures: Dict[Tuple[str, str, str], int] = {}
+    start_by_acc: Dict[str, int] = {}
+    end_by_acc: Dict[str, int] = {}
+    has_end_balances = False
+    for rows, is_curr in ((rows_prev, False), (rows_curr, True)):
+        for row in rows:
+            code = _account_code(row.get("Account.Name"))
+            if code < 0:
+                continue
+            account = ACCOUNT_CATEGORIES[code]
+            final = _to_kopecks(row.get("FinalBalance.Money"))
+            l1 = row.get(l1_col)
+            if _is_missing(l1):
+                # Строки без статьи — остатки по кассе
+                if is_curr:
+                    has_end_balances = True
+                    end_by_acc[account] = end_by_acc.get(account, 0) + final
+                else:
+                    start_by_acc[account] = start_by_acc.get(account, 0) + final
+                continue
+            l1 = CATEGORY_RU_MAP.get(l1, l1)
+            if is_curr:
+                for measure, value in (
+                    ("curr_fb", final),
+                    ("curr_in", _to_kopecks(row.get("Sum.Incoming"))),
+                    ("curr_out", _to_kopecks(row.get("Sum.Outgoing"))),
+                ):
+                    key = (account, l1, measure)
+                    measures[key] = measures.get(key, 0) + value
+            else:
+                key = (account, l1, "prev_fb")
+                measures[key] = measures.get(key, 0) + final
+    if not has_end_balances:
+        end_by_acc = start_by_acc
+    balances = {"start_balance": start_by_acc, "end_balance": end_by_acc}
+    values = np.zeros(len(compiled.sources), dtype=np.int64)
+    for pos in compiled.category_pos:
+        values[pos] = measures.get(compiled.sources[pos], 0)
+    for pos, account, measure in compiled.balance_sources:
+        values[pos] = balances[measure].get(account, 0)
+    return values
+
+
+def build_excel_cashflow_table(
+    json_prev: OlapData, json_curr: OlapData, fast_path: Optional[bool] = None
+) -> pd.DataFrame:
     """
     Create Excel-ready table with columns A-R based on mapping rules:
     A: Тип статьи ДДС (mapped from CashFlowCategory.Type)
@@ -708,382 +1080,182 @@ def build_excel_cashflow_table(json_prev: Dict[str, Any], json_curr: Dict[str, A
     J-N: Главная касса (Start J, Incoming L, Outgoing M, Final N)
     O-R: Итого (Start O, Incoming P, Outgoing Q, Final R)
 
+    Amounts in E-R are integer kopecks; export_excel_cashflow and
+    build_full_cashflow_tree convert them to rubles when rendering.
+
     Special rows: "Операционная деятельность всего", "Финансовая деятельность всего", "Итого".
+    Rows, their sources and subtotals are defined by EXCEL_LAYOUT.
+
+    JSON-ответы не длиннее FAST_PATH_MAX_ROWS строк агрегируются без pandas
+    (_small_layout_sources); fast_path=True/False выбирает путь явно, например для сверки.
     """
-    prev = pd.json_normalize(json_prev.get("data", []))
-    curr = pd.json_normalize(json_curr.get("data", []))
-
-    prev = _normalize_accounts(prev)
-    curr = _normalize_accounts(curr)
-    # Ensure columns exist and coerce numerics
-    numeric_cols = [
-        "Sum.Incoming",
-        "Sum.Outgoing",
-        "FinalBalance.Money",
-        "StartBalance.Money",
-    ]
-    meta_cols = [
-        "CashFlowCategory.HierarchyLevel1",
-        "CashFlowCategory.HierarchyLevel2",
-        "CashFlowCategory.HierarchyLevel3",
-        "CashFlowCategory.Type",
-    ]
-    for df in (prev, curr):
-        for col in numeric_cols + meta_cols:
-            if col not in df.columns:
-                df[col] = 0.0 if col in numeric_cols else None
-        for col in numeric_cols:
-            try:
-                df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0.0)
-            except Exception:
-                # Fallback to zeros if conversion fails
-                df[col] = 0.0
+    rows_prev, rows_curr = _olap_rows(json_prev), _olap_rows(json_curr)
+    small = rows_prev is not None and rows_curr is not None
+    if fast_path is None:
+        fast_path = small and max(len(rows_prev), len(rows_curr)) <= FAST_PATH_MAX_ROWS
+    if fast_path and small:
+        sources = _small_layout_sources(EXCEL_LAYOUT_COMPILED, rows_prev, rows_curr)
+        return _layout_table(EXCEL_LAYOUT_COMPILED, evaluate_layout(EXCEL_LAYOUT_COMPILED, sources))
+
+    prev = ingest_olap(json_prev)
+    curr = ingest_olap(json_curr)
+    numeric_cols = NUMERIC_COLS
 
     # Diagnostics: total sums to verify non-zero data
     try:
-        prev_tot = {c: float(prev[c].sum()) for c in numeric_cols if c in prev.columns}
-        curr_tot = {c: float(curr[c].sum()) for c in numeric_cols if c in curr.columns}
-        logging.info("[cashflow] prev totals: %s", prev_tot)
-        logging.info("[cashflow] curr totals: %s", curr_tot)
+        prev_tot = {c: int(prev[c].sum()) for c in numeric_cols if c in prev.columns}
+        curr_tot = {c: int(curr[c].sum()) for c in numeric_cols if c in curr.columns}
+        logging.info("[cashflow] prev totals (kopecks): %s", prev_tot)
+        logging.info("[cashflow] curr totals (kopecks): %s", curr_tot)
     except Exception:
         pass
 
-    # Helper mapping for type
-    def type_ru(t: Any) -> str:
-        if t == "OPERATIONAL":
-            return "Операционная деятельность"
-        if t == "FINANCE":
-            return "Финансовая деятельность"
-        return ""
-
-    # Build key by Account + L1
-    def make_key(row: pd.Series) -> Tuple[str, Any]:
-        return (str(row.get("AccountNorm", "")), row.get("CashFlowCategory.HierarchyLevel1"))
-
     # Start balances from previous day: rows where L1 is null -> account totals
     prev_balances = prev[prev["CashFlowCategory.HierarchyLevel1"].isna()] if len(prev) else prev
-    start_by_acc = prev_balances.groupby("AccountNorm")["FinalBalance.Money"].sum() if not prev_balances.empty else pd.Series(dtype=float)
+    start_by_acc = prev_balances.groupby("AccountNorm", observed=True)["FinalBalance.Money"].sum() if not prev_balances.empty else pd.Series(dtype="int64")
 
-    # Current day movements and final balances
-    curr_flows = curr[curr["CashFlowCategory.HierarchyLevel1"].notna()] if len(curr) else curr
     # Current day end balances (rows where L1 is null)
     curr_balances = curr[curr["CashFlowCategory.HierarchyLevel1"].isna()] if len(curr) else curr
-    end_by_acc = curr_balances.groupby("AccountNorm")["FinalBalance.Money"].sum() if not curr_balances.empty else start_by_acc
-
-    # Aggregate incoming/outgoing per account + L1 + type
-    agg_cols = [
-        "CashFlowCategory.Type",
-        "CashFlowCategory.HierarchyLevel1",
-        "CashFlowCategory.HierarchyLevel2",
-        "CashFlowCategory.HierarchyLevel3",
-        "AccountNorm",
-    ]
-    if not curr_flows.empty:
-        flows_agg = (
-            curr_flows.groupby(agg_cols)[["Sum.Incoming", "Sum.Outgoing", "FinalBalance.Money"]]
-            .sum()
-            .reset_index()
-        )
-    else:
-        flows_agg = pd.DataFrame(columns=agg_cols + ["Sum.Incoming", "Sum.Outgoing", "FinalBalance.Money"])  # empty
+    end_by_acc = curr_balances.groupby("AccountNorm", observed=True)["FinalBalance.Money"].sum() if not curr_balances.empty else start_by_acc
 
-    # Collect all unique keys from current flows
-    keys = []
-    for _, r in flows_agg.iterrows():
-        keys.append(make_key(r))
-    # Ensure at least totals rows exist
-    keys = sorted(set(keys))
+    # Rows 9-18: declarative layout evaluated over the aggregated measures
+    measures = _aggregate_category_measures(prev, curr)
+    sources = _layout_sources(EXCEL_LAYOUT_COMPILED, measures, start_by_acc, end_by_acc)
+    values = evaluate_layout(EXCEL_LAYOUT_COMPILED, sources)
+    return _layout_table(EXCEL_LAYOUT_COMPILED, values)
 
-    rows = []
 
-    def add_row(type_label: str, l1: Any, l2: Any, l3: Any,
-                start_trade: float, in_trade: float, out_trade: float, fin_trade: float,
-                start_main: float, in_main: float, out_main: float, fin_main: float):
-        # Totals O-R
-        start_total = (start_trade or 0) + (start_main or 0)
-        in_total = (in_trade or 0) + (in_main or 0)
-        out_total = (out_trade or 0) + (out_main or 0)
-        fin_total = (fin_trade or 0) + (fin_main or 0)
-        rows.append({
-            "Тип статьи ДДС": type_label,
-            "Статья ДДС 1-го уровня": CATEGORY_RU_MAP.get(l1, l1) if l1 is not None else "",
-            "Статья ДДС 2-го уровня": l2 or "",
-            "Статья ДДС 3-го уровня": l3 or "",
-            # E-I: Главная касса (keep F blank)
-            "E": float(start_main or 0),
-            "F": "",
-            "G": float(in_main or 0),
-            "H": float(out_main or 0),
-            "I": float(fin_main or 0),
-            # J-N: Торговые кассы (keep K blank)
-            "J": float(start_trade or 0),
-            "K": "",
-            "L": float(in_trade or 0),
-            "M": float(out_trade or 0),
-            "N": float(fin_trade or 0),
-            # O-R: Итого
-            "O": float(start_total),
-            "P": float(in_total),
-            "Q": float(out_total),
-            "R": float(fin_total),
-        })
+EXCEL_SHEET_TITLE = "Отчет о движении денежных средс"
+# Строка 6: заголовки групп касс над колонками E:I, J:N, O:R
+EXCEL_MERGED_RANGES = ("E6:I6", "J6:N6", "O6:R6")
+EXCEL_VALUE_COLUMNS = ["E", "F", "G", "H", "I", "J", "K", "L", "M", "N", "O", "P", "Q", "R"]
+EXCEL_TEXT_COLUMNS = [
+    "Тип статьи ДДС",
+    "Статья ДДС 1-го уровня",
+    "Статья ДДС 2-го уровня",
+    "Статья ДДС 3-го уровня",
+]
 
-    # Row 9: Общие остатки по кассам
-    # E9/J9: FinalBalance (prev, L1 is null) for Main/Trades; I9/N9: FinalBalance (curr, L1 is null)
-    try:
-        start_trade_val = float(start_by_acc.get(RU_ACCOUNT_TRADES, 0) or 0)
-    except Exception:
-        start_trade_val = 0.0
-    try:
-        start_main_val = float(start_by_acc.get(RU_ACCOUNT_MAIN, 0) or 0)
-    except Exception:
-        start_main_val = 0.0
-    try:
-        end_trade_val = float(end_by_acc.get(RU_ACCOUNT_TRADES, 0) or 0)
-    except Exception:
-        end_trade_val = 0.0
+
+def _excel_caption(date_caption: str) -> str:
+    # Format date to dd.mm.yyyy if ISO provided
     try:
-        end_main_val = float(end_by_acc.get(RU_ACCOUNT_MAIN, 0) or 0)
+        from datetime import datetime
+        return datetime.fromisoformat(date_caption).strftime("%d.%m.%Y")
     except Exception:
-        end_main_val = 0.0
+        return str(date_caption)
 
-    add_row(
-        "Общие остатки по кассам", None, None, None,
-        start_trade_val, 0.0, 0.0, end_trade_val,
-        start_main_val, 0.0, 0.0, end_main_val,
-    )
-
-    # --- Explicit rows mapping per specification ---
-    # Helper: build synonyms for a Russian category label
-    def l1_synonyms(ru_label: str) -> set:
-        syn = {ru_label}
-        try:
-            syn |= {k for k, v in CATEGORY_RU_MAP.items() if v == ru_label}
-        except Exception:
-            pass
-        return syn
-
-    # Prepare per-account, per-category aggregations from prev/curr
-    prev_cat = prev[prev["CashFlowCategory.HierarchyLevel1"].notna()]
-    curr_cat = curr[curr["CashFlowCategory.HierarchyLevel1"].notna()]
-    prev_fb = prev_cat.groupby(["AccountNorm", "CashFlowCategory.HierarchyLevel1"])  # type: ignore
-    prev_fb = prev_fb["FinalBalance.Money"].sum().to_dict() if not prev_cat.empty else {}
-    curr_fb = curr_cat.groupby(["AccountNorm", "CashFlowCategory.HierarchyLevel1"])  # type: ignore
-    curr_fb = curr_fb["FinalBalance.Money"].sum().to_dict() if not curr_cat.empty else {}
-    curr_in = curr_cat.groupby(["AccountNorm", "CashFlowCategory.HierarchyLevel1"])  # type: ignore
-    curr_in = curr_in["Sum.Incoming"].sum().to_dict() if not curr_cat.empty else {}
-    curr_out = curr_cat.groupby(["AccountNorm", "CashFlowCategory.HierarchyLevel1"])  # type: ignore
-    curr_out = curr_out["Sum.Outgoing"].sum().to_dict() if not curr_cat.empty else {}
-
-    def get_val(dct: Dict[Tuple[str, Any], float], acc: str, ru_label: str) -> float:
-        total = 0.0
-        for name in l1_synonyms(ru_label):
-            total += float(dct.get((acc, name), 0.0) or 0.0)
-        return total
-
-    # Row 10: Операционная деятельность / Внутреннее перемещение
-    l1 = "Внутреннее перемещение"
-    add_row(
-        "Операционная деятельность", l1, None, None,
-        # trades
-        get_val(prev_fb, RU_ACCOUNT_TRADES, l1), 0.0, get_val(curr_out, RU_ACCOUNT_TRADES, l1), get_val(curr_fb, RU_ACCOUNT_TRADES, l1),
-        # main
-        get_val(prev_fb, RU_ACCOUNT_MAIN, l1), get_val(curr_in, RU_ACCOUNT_MAIN, l1), 0.0, get_val(curr_fb, RU_ACCOUNT_MAIN, l1),
-    )
-
-    # Row 11: Выручка (operational, trades only)
-    l1 = "Выручка"
-    add_row(
-        "", l1, None, None,
-        # trades
-        get_val(prev_fb, RU_ACCOUNT_TRADES, l1), get_val(curr_in, RU_ACCOUNT_TRADES, l1), 0.0, get_val(curr_fb, RU_ACCOUNT_TRADES, l1),
-        # main (zeros)
-        0.0, 0.0, 0.0, 0.0,
-    )
-
-    # Row 12: Оплата накладных (both accounts, incoming/outgoing zero)
-    l1 = "Оплата накладных"
-    add_row(
-        "", l1, None, None,
-        # trades
-        get_val(prev_fb, RU_ACCOUNT_TRADES, l1), 0.0, 0.0, get_val(curr_fb, RU_ACCOUNT_TRADES, l1),
-        # main
-        get_val(prev_fb, RU_ACCOUNT_MAIN, l1), 0.0, 0.0, get_val(curr_fb, RU_ACCOUNT_MAIN, l1),
-    )
-
-    # Row 13: Оплата труда (main only)
-    l1 = "Оплата труда"
-    add_row(
-        "", l1, None, None,
-        # trades (zeros)
-        0.0, 0.0, 0.0, 0.0,
-        # main
-        get_val(prev_fb, RU_ACCOUNT_MAIN, l1), 0.0, 0.0, get_val(curr_fb, RU_ACCOUNT_MAIN, l1),
-    )
 
-    # Row 14: Подотчет (both accounts; H from main outgoing, M=0)
-    l1 = "Подотчет"
-    add_row(
-        "", l1, None, None,
-        # trades
-        get_val(prev_fb, RU_ACCOUNT_TRADES, l1), 0.0, 0.0, get_val(curr_fb, RU_ACCOUNT_TRADES, l1),
-        # main
-        get_val(prev_fb, RU_ACCOUNT_MAIN, l1), 0.0, get_val(curr_out, RU_ACCOUNT_MAIN, l1), get_val(curr_fb, RU_ACCOUNT_MAIN, l1),
-    )
-
-    # Row 15: Предоплата (trades only)
-    l1 = "Предоплата"
-    add_row(
-        "", l1, None, None,
-        # trades
-        get_val(prev_fb, RU_ACCOUNT_TRADES, l1), 0.0, 0.0, get_val(curr_fb, RU_ACCOUNT_TRADES, l1),
-        # main (zeros)
-        0.0, 0.0, 0.0, 0.0,
-    )
+def _cashflow_sheet_rows(table: pd.DataFrame, date_caption_fmt: str) -> Iterable[List[Any]]:
+    """
+    Строки листа по порядку, начиная с первой (None — пустая ячейка).
 
-    # Row 16: Операционная деятельность всего (sum rows 10-15)
-    op_rows = rows[-6:]
-    def sum_list(col: str) -> float:
-        try:
-            return float(pd.DataFrame(op_rows)[col].sum())
-        except Exception:
-            return 0.0
-    add_row(
-        "Операционная деятельность всего", None, None, None,
-        # trades sums
-        sum_list("J"), sum_list("L"), sum_list("M"), sum_list("N"),
-        # main sums
-        sum_list("E"), sum_list("G"), sum_list("H"), sum_list("I"),
+    Шапка (строки 1-8) и данные с 9-й строки; суммы переводятся из копеек в рубли.
+    """
+    # B1: Report title, B2: Restaurant name, B3: Date (from provided caption)
+    yield [None, "Отчет о движении денежных средств1"]
+    yield [None, "Название ресторана: Таврика local cafe"]
+    yield [None, f"Дата: {date_caption_fmt}"]
+    yield []
+    # Row 5: Single header in E5
+    yield [None, None, None, None, "Счет"]
+    # Row 6: Group headers, merged via EXCEL_MERGED_RANGES
+    yield [None] * 4 + ["Главная касса"] + [None] * 4 + ["Торговые кассы"] + [None] * 4 + ["Итого"]
+    yield []
+    # Row 8: Column headers; sub-headers for accounts (leave F8 and K8 blank)
+    account_headers = [
+        "Начальный денежный остаток, р.",
+        "Сумма прихода, р.",
+        "Сумма расхода, р.",
+        "Конечный денежный остаток, р.",
+    ]
+    yield (
+        EXCEL_TEXT_COLUMNS
+        + account_headers[:1] + [None] + account_headers[1:]  # E-I: Главная касса
+        + account_headers[:1] + [None] + account_headers[1:]  # J-N: Торговые кассы
+        + account_headers                                     # O-R: Итого
     )
 
-    # Row 17: Финансовая деятельность / Займ (main only)
-    l1 = "Займ"
-    add_row(
-        "Финансовая деятельность", l1, None, None,
-        # trades (zeros)
-        0.0, 0.0, 0.0, 0.0,
-        # main
-        get_val(prev_fb, RU_ACCOUNT_MAIN, l1), 0.0, 0.0, get_val(curr_fb, RU_ACCOUNT_MAIN, l1),
-    )
+    # Data rows start at row 9 (after headers); E-R contiguous without separators
+    # Колонки читаются лениво, построчно — без промежуточных копий таблицы
+    columns = [iter(table[c]) if c in table.columns else repeat("", len(table)) for c in EXCEL_TEXT_COLUMNS]
+    columns += [
+        map(kopecks_to_rubles, table[c]) if c in table.columns else repeat("", len(table))
+        for c in EXCEL_VALUE_COLUMNS
+    ]
+    yield from (list(values) for values in zip(*columns))
 
-    # Row 18: Итого (row9 + row16 + row17)
-    # capture rows by index positions based on appended order
-    r9 = rows[0]
-    r16 = rows[-2]
-    r17 = rows[-1]
-    add_row(
-        "Итого", None, None, None,
-        # trades
-        float(r9.get("J", 0) or 0) + float(r16.get("J", 0) or 0) + float(r17.get("J", 0) or 0),
-        float(r9.get("L", 0) or 0) + float(r16.get("L", 0) or 0) + float(r17.get("L", 0) or 0),
-        float(r9.get("M", 0) or 0) + float(r16.get("M", 0) or 0) + float(r17.get("M", 0) or 0),
-        float(r9.get("N", 0) or 0) + float(r16.get("N", 0) or 0) + float(r17.get("N", 0) or 0),
-        # main
-        float(r9.get("E", 0) or 0) + float(r16.get("E", 0) or 0) + float(r17.get("E", 0) or 0),
-        float(r9.get("G", 0) or 0) + float(r16.get("G", 0) or 0) + float(r17.get("G", 0) or 0),
-        float(r9.get("H", 0) or 0) + float(r16.get("H", 0) or 0) + float(r17.get("H", 0) or 0),
-        float(r9.get("I", 0) or 0) + float(r16.get("I", 0) or 0) + float(r17.get("I", 0) or 0),
-    )
 
-    # Final DataFrame in display order: A-D then E-R
-    table = pd.DataFrame(rows, columns=[
-        "Тип статьи ДДС",
-        "Статья ДДС 1-го уровня",
-        "Статья ДДС 2-го уровня",
-        "Статья ДДС 3-го уровня",
-        "E", "F", "G", "H", "I",
-        "J", "K", "L", "M", "N",
-        "O", "P", "Q", "R",
-    ])
+def _cashflow_workbook(table: pd.DataFrame, date_caption_fmt: str, streaming: bool = True):
+    """
+    Книга openpyxl с листом ДДС.
 
-    return table
+    streaming=True — write-only книга: строки уходят в поток по мере добавления, память
+    не растёт с числом строк (такую книгу можно сохранить только один раз).
+    streaming=False — обычная книга с полной моделью ячеек.
+    """
+    from openpyxl import Workbook
 
+    wb = Workbook(write_only=streaming)
+    if streaming:
+        ws = wb.create_sheet(EXCEL_SHEET_TITLE)
+        for values in _cashflow_sheet_rows(table, date_caption_fmt):
+            ws.append(values)
+    else:
+        ws = wb.active
+        ws.title = EXCEL_SHEET_TITLE
+        for r_idx, values in enumerate(_cashflow_sheet_rows(table, date_caption_fmt), start=1):
+            for c_idx, value in enumerate(values, start=1):
+                if value is not None:
+                    ws.cell(row=r_idx, column=c_idx, value=value)
+    # Объединения записываются в конце листа, поэтому годятся и для write-only режима
+    for cell_range in EXCEL_MERGED_RANGES:
+        ws.merged_cells.add(cell_range)
+    return wb
+
+
+def render_excel_cashflow(
+    json_prev: OlapData,
+    json_curr: OlapData,
+    date_caption: str,
+    filename: str | None = None,
+    streaming: bool = True,
+) -> Tuple[bytes, str]:
+    """
+    XLSX целиком в памяти: (содержимое файла, предлагаемое имя).
 
-def export_excel_cashflow(json_prev: Dict[str, Any], json_curr: Dict[str, Any], date_caption: str, path: str | None = None) -> str:
+    Без записи на диск — для отправки в Telegram прямо из буфера. Имя по умолчанию —
+    дата отчёта, например 09.10.2025.xlsx.
+    """
+    table = build_excel_cashflow_table(json_prev, json_curr)
+    date_caption_fmt = _excel_caption(date_caption)
+    buffer = io.BytesIO()
+    _cashflow_workbook(table, date_caption_fmt, streaming).save(buffer)
+    return buffer.getvalue(), filename or f"{date_caption_fmt}.xlsx"
+
+
+def export_excel_cashflow(
+    json_prev: OlapData,
+    json_curr: OlapData,
+    date_caption: str,
+    path: str | None = None,
+    streaming: bool = True,
+) -> str:
     """
     Export mapped cashflow to Excel with header (restaurant name + date) and table.
+
+    По умолчанию лист пишется потоково (openpyxl write-only), см. _cashflow_workbook.
     """
     table = build_excel_cashflow_table(json_prev, json_curr)
-    # Format date to dd.mm.yyyy if ISO provided
-    try:
-        from datetime import datetime
-        date_caption_fmt = datetime.fromisoformat(date_caption).strftime("%d.%m.%Y")
-    except Exception:
-        date_caption_fmt = str(date_caption)
+    date_caption_fmt = _excel_caption(date_caption)
 
     # If path not provided, default to date-based filename like 09.10.2025.xlsx
     if path is None or not str(path).strip():
         path = f"{date_caption_fmt}.xlsx"
 
-    # Write using openpyxl to build multi-row headers
-    from openpyxl import Workbook
-    from openpyxl.utils import get_column_letter
-    from openpyxl.worksheet.worksheet import Worksheet
-
-    wb = Workbook()
-    ws: Worksheet = wb.active
-    ws.title = "Отчет о движении денежных средс"
-
-    # Fixed headers:
-    # B1: Report title
-    ws.cell(row=1, column=2, value="Отчет о движении денежных средств1")
-    # B2: Restaurant name
-    ws.cell(row=2, column=2, value="Название ресторана: Таврика local cafe")
-    # B3: Date (from provided caption)
-    ws.cell(row=3, column=2, value=f"Дата: {date_caption_fmt}")
-
-    # Row 5: Single header in E5
-    ws.cell(row=5, column=5, value="Счет")
-    # Row 6: Group headers with merges (E:I, J:N, O:R)
-    ws.cell(row=6, column=5, value="Главная касса")
-    ws.merge_cells(start_row=6, start_column=5, end_row=6, end_column=9)
-    ws.cell(row=6, column=10, value="Торговые кассы")
-    ws.merge_cells(start_row=6, start_column=10, end_row=6, end_column=14)
-    ws.cell(row=6, column=15, value="Итого")
-    ws.merge_cells(start_row=6, start_column=15, end_row=6, end_column=18)
-
-    # Row 8: Column headers
-    headers_a_d = [
-        "Тип статьи ДДС",
-        "Статья ДДС 1-го уровня",
-        "Статья ДДС 2-го уровня",
-        "Статья ДДС 3-го уровня",
-    ]
-    for idx, h in enumerate(headers_a_d, start=1):
-        ws.cell(row=8, column=idx, value=h)
-    # Row 8: Sub-headers for accounts (leave F8 and K8 blank)
-    # E-I: Главная касса
-    ws.cell(row=8, column=5, value="Начальный денежный остаток, р.")  # E8
-    ws.cell(row=8, column=7, value="Сумма прихода, р.")               # G8
-    ws.cell(row=8, column=8, value="Сумма расхода, р.")               # H8
-    ws.cell(row=8, column=9, value="Конечный денежный остаток, р.")   # I8
-    # J-N: Торговые кассы
-    ws.cell(row=8, column=10, value="Начальный денежный остаток, р.") # J8
-    ws.cell(row=8, column=12, value="Сумма прихода, р.")              # L8
-    ws.cell(row=8, column=13, value="Сумма расхода, р.")              # M8
-    ws.cell(row=8, column=14, value="Конечный денежный остаток, р.")  # N8
-    # O-R: Итого
-    ws.cell(row=8, column=15, value="Начальный денежный остаток, р.") # O8
-    ws.cell(row=8, column=16, value="Сумма прихода, р.")              # P8
-    ws.cell(row=8, column=17, value="Сумма расхода, р.")              # Q8
-    ws.cell(row=8, column=18, value="Конечный денежный остаток, р.")  # R8
-
-    # Data rows start at row 9 (after headers)
-    start_row = 9
-    for r_idx, row in enumerate(table.to_dict(orient="records"), start=start_row):
-        t = str(row.get("Тип статьи ДДС", "")).strip()
-        # A-D
-        ws.cell(row=r_idx, column=1, value=row.get("Тип статьи ДДС", ""))
-        ws.cell(row=r_idx, column=2, value=row.get("Статья ДДС 1-го уровня", ""))
-        ws.cell(row=r_idx, column=3, value=row.get("Статья ДДС 2-го уровня", ""))
-        ws.cell(row=r_idx, column=4, value=row.get("Статья ДДС 3-го уровня", ""))
-        # E-R numeric cells (contiguous mapping without separators)
-        for col_idx, key in enumerate(["E","F","G","H","I","J","K","L","M","N","O","P","Q","R"], start=5):
-            ws.cell(row=r_idx, column=col_idx, value=row.get(key, ""))
-
     # Save workbook with fallback if the target file is locked/open
     try:
-        wb.save(path)
+        _cashflow_workbook(table, date_caption_fmt, streaming).save(path)
         return path
     except PermissionError:
         from datetime import datetime
@@ -1091,14 +1263,16 @@ def export_excel_cashflow(json_prev: Dict[str, Any], json_curr: Dict[str, Any],
         ext = ext or ".xlsx"
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         alt_path = f"{root}_{ts}{ext}"
-        wb.save(alt_path)
+        # Write-only книга сохраняется один раз, поэтому собираем её заново
+        _cashflow_workbook(table, date_caption_fmt, streaming).save(alt_path)
         return alt_path
 
 
-
 def build_full_cashflow_tree(table: pd.DataFrame, date_str: str) -> str:
     """
     Преобразует cashflow table в текстовое дерево с ├── / └── и возвращает как строку.
+
+    Суммы таблицы — копейки; в рубли они переводятся только при форматировании.
     """
     cash_names = ["Главная касса", "Торговые кассы"]
     cash_columns = {
@@ -1127,41 +1301,47 @@ def build_full_cashflow_tree(table: pd.DataFrame, date_str: str) -> str:
                 child_prefix = prefix + ("    " if is_last else "│   ")
                 text_lines.extend(tree_to_text(val, child_prefix))
             else:
-                text_lines.append(f"{prefix}{pointer} {key}: {val:,.2f}")
+                text_lines.append(f"{prefix}{pointer} {key}: {format_rubles(val)}")
         return text_lines
 
-    # Строим дерево для каждой кассы
-    def build_tree_for_cash(cash_name: str) -> dict:
-        tree = {}
-        for _, row in table.iterrows():
-            type_label = row.get("Тип статьи ДДС", "").strip()
-            l1 = row.get("Статья ДДС 1-го уровня", "").strip()
-            l2 = row.get("Статья ДДС 2-го уровня", "").strip()
-            l3 = row.get("Статья ДДС 3-го уровня", "").strip()
-
-            node_lvl = tree
-            if type_label:
-                node_lvl = node_lvl.setdefault(type_label, {})
-            if l1:
-                node_lvl = node_lvl.setdefault(l1, {})
-            if l2:
-                node_lvl = node_lvl.setdefault(l2, {})
-            if l3:
-                node_lvl = node_lvl.setdefault(l3, {})
-
-            for col_name, label in zip(cash_columns[cash_name],
-                                       ["Начальный денежный остаток, р.",
-                                        "Сумма прихода, р.",
-                                        "Сумма расхода, р.",
-                                        "Конечный денежный остаток, р."]):
-                node_lvl[label] = row.get(col_name, 0.0)
-        return tree
+    measure_labels = [
+        "Начальный денежный остаток, р.",
+        "Сумма прихода, р.",
+        "Сумма расхода, р.",
+        "Конечный денежный остаток, р.",
+    ]
+    label_cols = [
+        "Тип статьи ДДС",
+        "Статья ДДС 1-го уровня",
+        "Статья ДДС 2-го уровня",
+        "Статья ДДС 3-го уровня",
+    ]
+
+    # Деревья всех касс строим за один проход по строкам таблицы
+    trees: Dict[str, dict] = {cash_name: {} for cash_name in cash_names}
+    value_cols = [col for cash_name in cash_names for col in cash_columns[cash_name]]
+    columns = [
+        table[col].fillna("").astype(str).str.strip().tolist() if col in table.columns else [""] * len(table)
+        for col in label_cols
+    ] + [
+        table[col].tolist() if col in table.columns else [0] * len(table)
+        for col in value_cols
+    ]
+    for record in zip(*columns):
+        path = [part for part in record[:4] if part]
+        values = record[4:]
+        for cash_idx, cash_name in enumerate(cash_names):
+            node_lvl = trees[cash_name]
+            for part in path:
+                node_lvl = node_lvl.setdefault(part, {})
+            offset = cash_idx * len(measure_labels)
+            for label_idx, label in enumerate(measure_labels):
+                node_lvl[label] = values[offset + label_idx]
 
     # Собираем строки
     lines.append(f"Дата: {date_str}")
     for cash_name in cash_names:
         lines.append(cash_name)
-        cash_tree = build_tree_for_cash(cash_name)
-        lines.extend(tree_to_text(cash_tree, prefix="    "))
+        lines.extend(tree_to_text(trees[cash_name], prefix="    "))
 
     return "\n".join(lines)
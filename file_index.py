@@ -0,0 +1,54 @@
+import logging
+import time
+from typing import Optional
+
+from storage import SqliteStore
+
+
+FILE_INDEX_DB_NAME = "telegram_files.sqlite3"
+
+
+class TelegramFileIndex(SqliteStore):
+    """Индекс file_id уже загруженных в Telegram отчётов (SQLite).
+
+    Ключ — (вид отчёта, диапазон дат, отпечаток данных). Пока данные не изменились,
+    повторная отправка идёт по file_id без загрузки файла.
+    """
+
+    DB_NAME = FILE_INDEX_DB_NAME
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            kind TEXT NOT NULL,
+            date_range TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            uploaded_at REAL NOT NULL,
+            PRIMARY KEY (kind, date_range, fingerprint)
+        );
+    """
+
+    def get(self, kind: str, date_range: str, fingerprint: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM telegram_files WHERE kind = ? AND date_range = ? AND fingerprint = ?",
+                (kind, date_range, fingerprint),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, kind: str, date_range: str, fingerprint: str, file_id: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO telegram_files (kind, date_range, fingerprint, file_id, uploaded_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (kind, date_range, fingerprint, file_id, time.time()),
+            )
+            self._conn.commit()
+
+    def forget(self, kind: str, date_range: str, fingerprint: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM telegram_files WHERE kind = ? AND date_range = ? AND fingerprint = ?",
+                (kind, date_range, fingerprint),
+            )
+            self._conn.commit()
+        logging.info("Forgot Telegram file_id for %s %s", kind, date_range)
@@ -1,16 +1,94 @@
+import asyncio
+import httpx
 import requests
 import logging
-from typing import Dict, Any, Optional
+import threading
+import time
+from typing import Dict, Any, Optional, Tuple
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from olap_cache import OlapCache
+
+
+# Время жизни токена iiko по умолчанию (сек); после него выполняется повторный auth
+DEFAULT_TOKEN_TTL = 15 * 60
+# Статусы OLAP, при которых токен считается недействительным
+AUTH_ERROR_STATUSES = (401, 403)
+# Статусы, при которых запрос повторяется (как Retry в синхронном клиенте)
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+# Поле группировки по дням для многодневных запросов
+DAY_FIELD = "DateTime.DateTyped"
+
+
+def _olap_transactions_payload(date_from: str, date_to: str, by_day: bool = False) -> Dict[str, Any]:
+    """Тело POST OLAP (TRANSACTIONS) для свода ДДС по двум кассам.
+
+    При by_day=True строки дополнительно группируются по дню (DateTime.DateTyped), а
+    фильтр по точным именам касс не ставится: кассы выбираются в cashflow тем же
+    сопоставлением имён, что и для отчёта по пресету, и отчёты за день и за период сходятся.
+    """
+    day_fields = [DAY_FIELD] if by_day else []
+    filters: Dict[str, Any] = {
+        "DateTime.DateTyped": {
+            "filterType": "DateRange",
+            "from": date_from,
+            "to": date_to,
+            "includeLow": True,
+            "includeHigh": True,
+        },
+        "Account.IsCashFlowAccount": {
+            "filterType": "IncludeValues",
+            "values": ["CASH_FLOW"],
+        },
+    }
+    if not by_day:
+        filters["Account.Name"] = {
+            "filterType": "IncludeValues",
+            "values": ["Главная касса", "Торговые кассы"],
+        }
+    return {
+        "reportType": "TRANSACTIONS",
+        "buildSummary": True,
+        "groupByRowFields": day_fields + [
+            "CashFlowCategory.Type",
+            "CashFlowCategory.HierarchyLevel1",
+            "CashFlowCategory.HierarchyLevel2",
+            "CashFlowCategory.HierarchyLevel3",
+        ],
+        "groupByColFields": ["Account.Name"],
+        "aggregateFields": [
+            "Sum.Incoming",
+            "Sum.Outgoing",
+            "StartBalance.Money",
+            "FinalBalance.Money",
+        ],
+        "filters": filters,
+    }
+
 
 class IikoClient:
-    def __init__(self, base_url: str, login: str, password: str):
+    """Синхронный клиент iiko для скриптов и разовых выгрузок вне event loop.
+
+    Бот использует AsyncIikoClient; кэш OLAP и разбивка по дням есть только там.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        login: str,
+        password: str,
+        token_ttl: float = DEFAULT_TOKEN_TTL,
+    ):
         self.base_url = base_url.rstrip('/')
         self.login = login
         self.password = password
         self.token: Optional[str] = None
+        self.token_ttl = token_ttl
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
         self.session = requests.Session()
         # Настраиваем ретраи для устойчивости к сетевым ошибкам и 5xx
         retries = Retry(
@@ -31,12 +109,50 @@ class IikoClient:
         resp.raise_for_status()
         # iiko returns token as plain text
         self.token = resp.text.strip()
+        self._token_expires_at = time.monotonic() + self.token_ttl
         return self.token
 
     def ensure_token(self) -> str:
-        if not self.token:
-            return self.auth()
-        return self.token
+        with self._token_lock:
+            if not self.token or time.monotonic() >= self._token_expires_at:
+                return self.auth()
+            return self.token
+
+    def invalidate_token(self, token: Optional[str] = None) -> None:
+        """Сбрасывает токен (если он не был уже обновлён другим потоком)."""
+        with self._token_lock:
+            if token is None or self.token == token:
+                self.token = None
+                self._token_expires_at = 0.0
+
+    def logout(self) -> None:
+        """Освобождает лицензию iiko: /resto/api/logout для текущего токена."""
+        with self._token_lock:
+            token, self.token = self.token, None
+            self._token_expires_at = 0.0
+        if not token:
+            return
+        try:
+            self.session.get(f"{self.base_url}/resto/api/logout", params={"key": token}, timeout=10)
+        except Exception:
+            logging.warning("iiko logout failed", exc_info=True)
+
+    def close(self) -> None:
+        self.logout()
+        self.session.close()
+
+    def _request(self, method: str, url: str, params: Dict[str, Any], **kwargs: Any) -> requests.Response:
+        """Запрос с ключом; при 401/403 один раз переавторизуется и повторяет."""
+        for attempt in range(2):
+            token = self.ensure_token()
+            resp = self.session.request(method, url, params={**params, "key": token}, **kwargs)
+            if resp.status_code in AUTH_ERROR_STATUSES and attempt == 0:
+                logging.info("iiko token rejected (%s), re-authenticating", resp.status_code)
+                self.invalidate_token(token)
+                continue
+            break
+        resp.raise_for_status()
+        return resp
 
     def fetch_olap_transactions(self, date_from: str, date_to: str) -> Dict[str, Any]:
         """Запрос OLAP (TRANSACTIONS) через прямой POST, без presetId.
@@ -44,49 +160,14 @@ class IikoClient:
         Формирует свод по ДДС: балансы и операционные движения по счетам
         "Главная касса" и "Торговые кассы" за указанный период.
         """
-        token = self.ensure_token()
         url = f"{self.base_url}/resto/api/v2/reports/olap"
-        params = {"key": token, "format": "json"}
-        payload = {
-            "reportType": "TRANSACTIONS",
-            "buildSummary": True,
-            "groupByRowFields": [
-                "CashFlowCategory.Type",
-                "CashFlowCategory.HierarchyLevel1",
-                "CashFlowCategory.HierarchyLevel2",
-                "CashFlowCategory.HierarchyLevel3",
-            ],
-            "groupByColFields": ["Account.Name"],
-            "aggregateFields": [
-                "Sum.Incoming",
-                "Sum.Outgoing",
-                "StartBalance.Money",
-                "FinalBalance.Money",
-            ],
-            "filters": {
-                "DateTime.DateTyped": {
-                    "filterType": "DateRange",
-                    "from": date_from,
-                    "to": date_to,
-                    "includeLow": True,
-                    "includeHigh": True,
-                },
-                "Account.IsCashFlowAccount": {
-                    "filterType": "IncludeValues",
-                    "values": ["CASH_FLOW"],
-                },
-                "Account.Name": {
-                    "filterType": "IncludeValues",
-                    "values": ["Главная касса", "Торговые кассы"],
-                },
-            },
-        }
+        params = {"format": "json"}
+        payload = _olap_transactions_payload(date_from, date_to)
         try:
             logging.info("OLAP POST %s", url)
         except Exception:
             pass
-        resp = self.session.post(url, json=payload, params=params, timeout=60)
-        resp.raise_for_status()
+        resp = self._request("POST", url, params, json=payload, timeout=60)
         return resp.json()
 
     def fetch_olap_by_preset(self, preset_id: str, date_from: str, date_to: str) -> Dict[str, Any]:
@@ -95,10 +176,8 @@ class IikoClient:
 
         Возвращает структуру, аналогичную POST OLAP, за указанный интервал дат.
         """
-        token = self.ensure_token()
         url = f"{self.base_url}/resto/api/v2/reports/olap/byPresetId/{preset_id}"
         params = {
-            "key": token,
             "dateFrom": date_from,
             "dateTo": date_to,
             # формат обычно JSON по умолчанию, но явно зададим при наличии поддержки
@@ -109,6 +188,171 @@ class IikoClient:
             logging.info("OLAP GET byPresetId %s", url)
         except Exception:
             pass
-        resp = self.session.get(url, params=params, timeout=60)
+        resp = self._request("GET", url, params, timeout=60)
+        return resp.json()
+
+
+class AsyncIikoClient:
+    """Асинхронный вариант IikoClient на httpx.AsyncClient с общим пулом соединений.
+
+    Используется ботом напрямую из колбэков, без asyncio.to_thread.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        login: str,
+        password: str,
+        token_ttl: float = DEFAULT_TOKEN_TTL,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        max_connections: int = 10,
+        cache: Optional[OlapCache] = None,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.login = login
+        self.password = password
+        self.cache = cache
+        self.token: Optional[str] = None
+        self.token_ttl = token_ttl
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+        self.session = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, connect=30.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def _send(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """Запрос с повтором при сетевых ошибках и 5xx."""
+        attempt = 0
+        while True:
+            try:
+                resp = await self.session.request(method, url, **kwargs)
+                if resp.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return resp
+            except httpx.TransportError:
+                if attempt >= self.retries:
+                    raise
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    async def auth(self) -> str:
+        url = f"{self.base_url}/resto/api/auth"
+        params = {"login": self.login, "pass": self.password}
+        resp = await self._send("GET", url, params=params, timeout=30)
         resp.raise_for_status()
-        return resp.json()
\ No newline at end of file
+        self.token = resp.text.strip()
+        self._token_expires_at = time.monotonic() + self.token_ttl
+        return self.token
+
+    async def ensure_token(self) -> str:
+        async with self._token_lock:
+            if not self.token or time.monotonic() >= self._token_expires_at:
+                return await self.auth()
+            return self.token
+
+    def invalidate_token(self, token: Optional[str] = None) -> None:
+        if token is None or self.token == token:
+            self.token = None
+            self._token_expires_at = 0.0
+
+    async def logout(self) -> None:
+        token, self.token = self.token, None
+        self._token_expires_at = 0.0
+        if not token:
+            return
+        try:
+            await self.session.get(f"{self.base_url}/resto/api/logout", params={"key": token}, timeout=10)
+        except Exception:
+            logging.warning("iiko logout failed", exc_info=True)
+
+    async def aclose(self) -> None:
+        await self.logout()
+        await self.session.aclose()
+
+    async def _request(self, method: str, url: str, params: Dict[str, Any], **kwargs: Any) -> httpx.Response:
+        for attempt in range(2):
+            token = await self.ensure_token()
+            resp = await self._send(method, url, params={**params, "key": token}, **kwargs)
+            if resp.status_code in AUTH_ERROR_STATUSES and attempt == 0:
+                logging.info("iiko token rejected (%s), re-authenticating", resp.status_code)
+                self.invalidate_token(token)
+                continue
+            break
+        resp.raise_for_status()
+        return resp
+
+    async def fetch_olap_transactions(self, date_from: str, date_to: str) -> Dict[str, Any]:
+        """Асинхронный аналог IikoClient.fetch_olap_transactions."""
+        url = f"{self.base_url}/resto/api/v2/reports/olap"
+        logging.info("OLAP POST %s", url)
+        resp = await self._request(
+            "POST", url, {"format": "json"}, json=_olap_transactions_payload(date_from, date_to), timeout=60
+        )
+        return resp.json()
+
+    async def fetch_olap_transactions_by_day(self, date_from: str, date_to: str) -> Dict[str, Any]:
+        """Один запрос OLAP (TRANSACTIONS) за весь диапазон с разбивкой по дням.
+
+        Границы включаются; строки содержат поле DateTime.DateTyped,
+        разделить ответ на дни можно через cashflow.split_olap_by_day.
+        """
+        url = f"{self.base_url}/resto/api/v2/reports/olap"
+        logging.info("OLAP POST (by day) %s", url)
+        resp = await self._request(
+            "POST",
+            url,
+            {"format": "json"},
+            json=_olap_transactions_payload(date_from, date_to, by_day=True),
+            timeout=120,
+        )
+        return resp.json()
+
+    async def fetch_olap_by_preset(
+        self, preset_id: str, date_from: str, date_to: str, refresh: bool = False
+    ) -> Dict[str, Any]:
+        """Асинхронный аналог IikoClient.fetch_olap_by_preset.
+
+        refresh=True идёт в iiko мимо кэша и перезаписывает кэш и снимок свежим ответом.
+        """
+        if self.cache is not None and not refresh:
+            cached = self.cache.get(preset_id, date_from, date_to)
+            if cached is not None:
+                return cached
+        url = f"{self.base_url}/resto/api/v2/reports/olap/byPresetId/{preset_id}"
+        logging.info("OLAP GET byPresetId %s", url)
+        resp = await self._request("GET", url, {"dateFrom": date_from, "dateTo": date_to}, timeout=60)
+        result = resp.json()
+        if self.cache is not None:
+            self.cache.put(preset_id, date_from, date_to, result)
+        return result
+
+
+_shared_async_clients: Dict[Tuple[str, str], AsyncIikoClient] = {}
+
+
+def get_shared_async_client(
+    base_url: str,
+    login: str,
+    password: str,
+    token_ttl: float = DEFAULT_TOKEN_TTL,
+    cache: Optional[OlapCache] = None,
+) -> AsyncIikoClient:
+    """Общий асинхронный клиент; вызывается из event loop бота."""
+    key = (base_url.rstrip('/'), login)
+    client = _shared_async_clients.get(key)
+    if client is None:
+        client = AsyncIikoClient(
+            base_url=base_url, login=login, password=password, token_ttl=token_ttl, cache=cache
+        )
+        _shared_async_clients[key] = client
+    return client
+
+
+async def aclose_shared_async_clients() -> None:
+    clients = list(_shared_async_clients.values())
+    _shared_async_clients.clear()
+    for client in clients:
+        await client.aclose()
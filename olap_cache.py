@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Dict, Optional, Tuple
+
+from snapshot_store import SnapshotStore
+
+
+CacheKey = Tuple[str, str, str]
+
+# Значения по умолчанию: размер LRU и TTL для диапазонов, затрагивающих сегодня (сек)
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_OPEN_TTL = 60.0
+
+
+def is_closed_range(date_to: str, today: Optional[date] = None) -> bool:
+    """Диапазон закрыт, если dateTo (граница не включается, как в запросах бота) не позже сегодня.
+
+    Такие данные уже не меняются, и их можно хранить без TTL.
+    """
+    try:
+        return date.fromisoformat(date_to) <= (today or date.today())
+    except (TypeError, ValueError):
+        return False
+
+
+class OlapCache:
+    """LRU-кэш ответов OLAP byPresetId с ключом (preset id, dateFrom, dateTo).
+
+    Закрытые дни хранятся бессрочно (до вытеснения по LRU), диапазоны с сегодняшним
+    днём — не дольше ``open_ttl`` секунд. Возвращаемые словари общие для всех
+    вызывающих, изменять их нельзя.
+
+    Если задан ``store``, закрытые дни дополнительно сохраняются на диск, а при
+    промахе в памяти сначала проверяется снимок.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        open_ttl: float = DEFAULT_OPEN_TTL,
+        store: Optional[SnapshotStore] = None,
+    ):
+        self.max_entries = max_entries
+        self.open_ttl = open_ttl
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self._entries: "OrderedDict[CacheKey, Tuple[Optional[float], Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, preset_id: str, date_from: str, date_to: str) -> Optional[Dict[str, Any]]:
+        key = (str(preset_id), date_from, date_to)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, payload = entry
+                if expires_at is None or time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+        if self.store is not None and is_closed_range(date_to):
+            payload = self.store.get(preset_id, date_from, date_to)
+            if payload is not None:
+                with self._lock:
+                    self.store_hits += 1
+                self._remember(key, None, payload)
+                return payload
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, preset_id: str, date_from: str, date_to: str, payload: Dict[str, Any]) -> None:
+        key = (str(preset_id), date_from, date_to)
+        closed = is_closed_range(date_to)
+        self._remember(key, None if closed else time.monotonic() + self.open_ttl, payload)
+        if closed and self.store is not None:
+            try:
+                self.store.put(preset_id, date_from, date_to, payload)
+            except Exception:
+                logging.warning("Failed to persist OLAP snapshot %s", key, exc_info=True)
+
+    def _remember(self, key: CacheKey, expires_at: Optional[float], payload: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,40 @@
+import asyncio
+import time
+from typing import Dict, Hashable
+
+
+# Лимиты Telegram Bot API: ~30 сообщений в секунду всего, 1 в секунду в личный чат, 20 в минуту в группу
+DEFAULT_GLOBAL_PER_SECOND = 25.0
+DEFAULT_CHAT_INTERVAL = 1.0
+DEFAULT_GROUP_INTERVAL = 3.0
+
+
+class SendRateLimiter:
+    """Распределяет отправки во времени с учётом общего лимита и лимита на чат.
+
+    wait(chat_id) резервирует ближайший допустимый момент и спит до него, поэтому
+    одновременные вызовы выстраиваются в очередь без превышения лимитов.
+    """
+
+    def __init__(
+        self,
+        global_per_second: float = DEFAULT_GLOBAL_PER_SECOND,
+        chat_interval: float = DEFAULT_CHAT_INTERVAL,
+        group_interval: float = DEFAULT_GROUP_INTERVAL,
+    ):
+        self.global_interval = 1.0 / global_per_second
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self._global_next = 0.0
+        self._chat_next: Dict[Hashable, float] = {}
+        self._lock = asyncio.Lock()
+
+    async def wait(self, chat_id: int) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._global_next, self._chat_next.get(chat_id, 0.0))
+            self._global_next = start + self.global_interval
+            # Отрицательный chat_id — группа или канал
+            self._chat_next[chat_id] = start + (self.group_interval if chat_id < 0 else self.chat_interval)
+        if start > now:
+            await asyncio.sleep(start - now)
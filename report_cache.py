@@ -0,0 +1,85 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Union
+
+
+# Значения по умолчанию: число отчётов в LRU и общий объём (байт)
+DEFAULT_REPORT_CACHE_ENTRIES = 64
+DEFAULT_REPORT_CACHE_BYTES = 32 * 1024 * 1024
+
+Artefact = Union[bytes, str]
+
+
+def payload_fingerprint(*payloads: Any) -> str:
+    """SHA-256 от канонического JSON (ключи отсортированы) всех входных срезов OLAP.
+
+    Одинаковые данные дают одинаковый отпечаток независимо от порядка ключей в ответе iiko.
+    """
+    digest = hashlib.sha256()
+    for payload in payloads:
+        blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        digest.update(blob.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def _artefact_size(value: Artefact) -> int:
+    return len(value) if isinstance(value, bytes) else len(value.encode("utf-8"))
+
+
+class ReportCache:
+    """LRU-кэш готовых отчётов (XLSX-байты или текст дерева).
+
+    Ключ составляет вызывающий: вид отчёта, даты и отпечаток данных
+    (payload_fingerprint), поэтому изменившиеся данные дают новый ключ, а старая запись
+    со временем вытесняется. Ограничен и числом записей, и суммарным объёмом.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_REPORT_CACHE_ENTRIES, max_bytes: int = DEFAULT_REPORT_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries: "OrderedDict[Hashable, Artefact]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Artefact]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Artefact) -> None:
+        size = _artefact_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= _artefact_size(old)
+            self._entries[key] = value
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= _artefact_size(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
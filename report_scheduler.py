@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+# Значения по умолчанию: число одновременных построений и предел очереди
+DEFAULT_REPORT_WORKERS = 2
+DEFAULT_REPORT_QUEUE_SIZE = 32
+
+
+class ReportQueueFull(RuntimeError):
+    """Очередь построения отчётов заполнена — запрос нужно повторить позже."""
+
+
+class _Job:
+    __slots__ = ("fn", "args", "future", "on_start", "enqueued_at")
+
+    def __init__(
+        self,
+        fn: Callable[..., Any],
+        args: tuple,
+        future: "asyncio.Future[Any]",
+        on_start: Optional[Callable[[], Any]],
+    ):
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.on_start = on_start
+        self.enqueued_at = time.monotonic()
+
+
+def _noop() -> None:
+    return None
+
+
+class ReportScheduler:
+    """Ограниченный пул построения отчётов (pandas/openpyxl) с очередью по чатам.
+
+    Одновременно выполняется не больше ``workers`` построений, в очереди ждёт не больше
+    ``max_queue`` задач. Чаты обслуживаются по кругу: десять отчётов одного
+    пользователя не задерживают единственный отчёт другого дольше, чем на одну задачу.
+
+    processes=True — задачи выполняются в процессах (spawn), которые при старте
+    импортируют pandas/openpyxl (``initializer``). Тогда функция и аргументы задачи должны
+    сериализоваться pickle: функции модульного уровня, словари, строки, bytes.
+    """
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_REPORT_WORKERS,
+        max_queue: int = DEFAULT_REPORT_QUEUE_SIZE,
+        processes: bool = False,
+        initializer: Optional[Callable[[], None]] = None,
+    ):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.processes = processes
+        self.completed = 0
+        self.max_wait = 0.0
+        self._wait_total = 0.0
+        self._pending = 0
+        self._running = 0
+        self._queues: "OrderedDict[Hashable, Deque[_Job]]" = OrderedDict()
+        self._executor: Executor
+        if processes:
+            # spawn, а не fork: процесс бота многопоточный (httpx, пул потоков, SQLite)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=initializer,
+            )
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="report")
+        self._wakeup: Optional[asyncio.Condition] = None
+        self._tasks: List["asyncio.Task[None]"] = []
+
+    def _ensure_workers(self) -> None:
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Condition()
+            self._tasks = [loop.create_task(self._worker(), name=f"report-worker-{i}") for i in range(self.workers)]
+
+    async def submit(
+        self,
+        chat_id: Hashable,
+        fn: Callable[..., T],
+        *args: Any,
+        on_start: Optional[Callable[[], Any]] = None,
+    ) -> T:
+        """Ставит fn(*args) в очередь чата и ждёт результата.
+
+        on_start вызывается в event loop, когда задачу взял воркер (например, для статуса).
+        """
+        self._ensure_workers()
+        if self._pending >= self.max_queue:
+            raise ReportQueueFull(f"Report queue is full ({self._pending} jobs)")
+        job = _Job(fn, args, asyncio.get_running_loop().create_future(), on_start)
+        self._queues.setdefault(chat_id, deque()).append(job)
+        self._pending += 1
+        async with self._wakeup:
+            self._wakeup.notify()
+        return await job.future
+
+    def _next_job(self) -> _Job:
+        # Первый чат в очереди отдаёт одну задачу и уходит в конец, если у него есть ещё
+        chat_id, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        del self._queues[chat_id]
+        if queue:
+            self._queues[chat_id] = queue
+        self._pending -= 1
+        return job
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._wakeup:
+                await self._wakeup.wait_for(lambda: self._pending > 0)
+                job = self._next_job()
+            if job.future.done():
+                continue
+            wait = time.monotonic() - job.enqueued_at
+            self._wait_total += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._running += 1
+            if job.on_start is not None:
+                try:
+                    job.on_start()
+                except Exception:
+                    logging.debug("Report job on_start failed", exc_info=True)
+            try:
+                result = await loop.run_in_executor(self._executor, job.fn, *job.args)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as exc:
+                if not job.future.done():
+                    job.future.set_exception(exc)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._running -= 1
+                self.completed += 1
+            logging.info("Report job done after %.2fs in queue (queued now: %d)", wait, self._pending)
+
+    async def prestart(self) -> None:
+        """Запускает все процессы пула заранее (инициализатор выполняется сразу, а не при первом отчёте)."""
+        if not self.processes:
+            return
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _noop) for _ in range(self.workers)))
+        logging.info("Report process pool ready in %.2fs (%d workers)", time.perf_counter() - started, self.workers)
+
+    def queue_depth(self) -> int:
+        return self._pending
+
+    def jobs_ahead(self, chat_id: Hashable) -> int:
+        """Сколько задач из очереди будет взято раньше новой задачи этого чата (с учётом обхода по кругу)."""
+        own = self._queues.get(chat_id)
+        rounds = len(own) if own is not None else 0
+        ahead = rounds
+        before = True
+        for other_id, queue in self._queues.items():
+            if other_id == chat_id:
+                # Чаты после нашего в текущем круге отдают задачу уже после нас
+                before = False
+                continue
+            ahead += min(len(queue), rounds + 1 if before else rounds)
+        return ahead
+
+    def busy(self) -> bool:
+        return self._running >= self.workers
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "mode": "process" if self.processes else "thread",
+            "running": self._running,
+            "queued": self._pending,
+            "chats": len(self._queues),
+            "completed": self.completed,
+            "avg_wait": round(self._wait_total / self.completed, 3) if self.completed else 0.0,
+            "max_wait": round(self.max_wait, 3),
+        }
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for queue in self._queues.values():
+            for job in queue:
+                job.future.cancel()
+        self._queues.clear()
+        self._pending = 0
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,44 @@
+"""Построение отчётов из сырых ответов OLAP.
+
+Функции модульного уровня с простыми аргументами (словари, строки) и результатом
+bytes/str, поэтому их можно выполнять и в потоке, и в отдельном процессе пула.
+cashflow (pandas/numpy) импортируется при первом вызове.
+"""
+import logging
+import os
+import time
+from typing import Any, Dict
+
+
+def _engine():
+    import cashflow
+
+    return cashflow
+
+
+def warm_up() -> None:
+    """Загружает pandas/openpyxl заранее (инициализатор процесса пула или фоновый прогрев)."""
+    started = time.perf_counter()
+    _engine()
+    import openpyxl  # noqa: F401
+
+    logging.info("Report engine loaded in %.2fs (pid %d)", time.perf_counter() - started, os.getpid())
+
+
+def render_day_xlsx(raw_previous: Dict[str, Any], raw_current: Dict[str, Any], date_from: str) -> bytes:
+    content, _ = _engine().render_excel_cashflow(raw_previous, raw_current, date_from)
+    return content
+
+
+def render_day_text(raw_previous: Dict[str, Any], raw_current: Dict[str, Any], date_from: str) -> str:
+    engine = _engine()
+    table = engine.build_excel_cashflow_table(raw_previous, raw_current)
+    return engine.build_full_cashflow_tree(table, date_str=date_from)
+
+
+def render_period_xlsx(raw_days: Dict[str, Any], date_pre: str, date_last: str, date_from: str) -> bytes:
+    # Остатки на начало — из дня перед периодом, движения и конечные остатки — из последнего дня
+    engine = _engine()
+    frames = engine.split_olap_by_day(raw_days, days=(date_pre, date_last))
+    content, _ = engine.render_excel_cashflow(frames[date_pre], frames[date_last], date_from)
+    return content
@@ -0,0 +1,43 @@
+import asyncio
+import functools
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Склеивает одинаковые одновременные запросы: ведомые ждут результат ведущего.
+
+    Работа ведущего запускается отдельной задачей и защищена shield, поэтому отмена
+    одного из ожидающих не прерывает построение отчёта для остальных.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Hashable, "asyncio.Task[Any]"] = {}
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+        else:
+            logging.info("Joining in-flight report %s", key)
+        return await asyncio.shield(task)
+
+    def coalesce(self, kind: str) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+        """Декоратор: ключ склейки — (kind, *позиционные аргументы)."""
+
+        def decorator(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+            @functools.wraps(fn)
+            async def wrapper(*args: Hashable) -> T:
+                return await self.run((kind, *args), lambda: fn(*args))
+
+            return wrapper
+
+        return decorator
+
+    def in_flight(self) -> int:
+        return len(self._inflight)
@@ -0,0 +1,54 @@
+import json
+import logging
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+from storage import SqliteStore
+
+
+SNAPSHOT_DB_NAME = "olap_snapshots.sqlite3"
+
+
+class SnapshotStore(SqliteStore):
+    """Хранилище снимков OLAP на диске (SQLite, JSON сжат zlib).
+
+    Ключ — (preset id, dateFrom, dateTo). Переживает перезапуск контейнера,
+    если каталог данных смонтирован как volume.
+    """
+
+    DB_NAME = SNAPSHOT_DB_NAME
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS olap_snapshots (
+            preset_id TEXT NOT NULL,
+            date_from TEXT NOT NULL,
+            date_to TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (preset_id, date_from, date_to)
+        );
+    """
+
+    def get(self, preset_id: str, date_from: str, date_to: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM olap_snapshots WHERE preset_id = ? AND date_from = ? AND date_to = ?",
+                (str(preset_id), date_from, date_to),
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            return json.loads(zlib.decompress(row[0]))
+        except Exception:
+            logging.warning("Corrupted OLAP snapshot %s %s..%s, ignoring", preset_id, date_from, date_to)
+            return None
+
+    def put(self, preset_id: str, date_from: str, date_to: str, payload: Dict[str, Any]) -> None:
+        blob = zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO olap_snapshots (preset_id, date_from, date_to, payload, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(preset_id), date_from, date_to, blob, time.time()),
+            )
+            self._conn.commit()
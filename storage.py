@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import threading
+
+
+# Каталог данных (снимки OLAP, индекс file_id, подписки); в Docker монтируется как volume
+DEFAULT_DATA_DIR = "data"
+
+
+class SqliteStore:
+    """Основа для хранилищ бота в SQLite.
+
+    Создаёт каталог и базу, включает WAL и выполняет SCHEMA. Соединение одно на
+    хранилище и используется из разных потоков под ``_lock``.
+    """
+
+    DB_NAME = ""
+    SCHEMA = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(self.SCHEMA)
+            self._conn.commit()
+
+    @classmethod
+    def in_data_dir(cls, data_dir: str = DEFAULT_DATA_DIR):
+        return cls(os.path.join(data_dir, cls.DB_NAME))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
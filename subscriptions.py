@@ -0,0 +1,106 @@
+import time
+from typing import List, NamedTuple, Tuple
+
+from storage import SqliteStore
+
+
+SUBSCRIPTIONS_DB_NAME = "subscriptions.sqlite3"
+# Что присылать: файл XLSX, текстовое дерево или оба
+SUBSCRIPTION_FORMATS = ("xlsx", "text", "both")
+# Формат подписки -> отдельные отправки, о каждой ведётся своя отметка
+SUBSCRIPTION_PARTS = {"xlsx": ("xlsx",), "text": ("text",), "both": ("xlsx", "text")}
+
+
+class Subscription(NamedTuple):
+    chat_id: int
+    formats: str
+    send_at: str
+    last_sent_xlsx: str
+    last_sent_text: str
+
+    def pending(self, today: str) -> Tuple[str, ...]:
+        """Части отчёта ("xlsx", "text"), которые сегодня ещё не доставлены."""
+        sent = {"xlsx": self.last_sent_xlsx, "text": self.last_sent_text}
+        return tuple(part for part in SUBSCRIPTION_PARTS[self.formats] if sent[part] != today)
+
+
+class SubscriptionStore(SqliteStore):
+    """Подписки чатов на ежедневный отчёт (SQLite).
+
+    Для каждого чата хранятся формат, время отправки HH:MM, дата последней доставки
+    отдельно для XLSX и текста, а также число неудачных попыток за день.
+    """
+
+    DB_NAME = SUBSCRIPTIONS_DB_NAME
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id INTEGER PRIMARY KEY,
+            formats TEXT NOT NULL,
+            send_at TEXT NOT NULL,
+            last_sent_xlsx TEXT NOT NULL DEFAULT '',
+            last_sent_text TEXT NOT NULL DEFAULT '',
+            failed_day TEXT NOT NULL DEFAULT '',
+            failures INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        );
+    """
+
+    def subscribe(self, chat_id: int, formats: str, send_at: str) -> None:
+        if formats not in SUBSCRIPTION_FORMATS:
+            raise ValueError(f"Unknown subscription format: {formats}")
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO subscriptions (chat_id, formats, send_at, created_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET formats = excluded.formats, send_at = excluded.send_at",
+                (chat_id, formats, send_at, time.time()),
+            )
+            self._conn.commit()
+
+    def unsubscribe(self, chat_id: int) -> bool:
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+            self._conn.commit()
+        return cur.rowcount > 0
+
+    def migrate_chat(self, old_chat_id: int, new_chat_id: int) -> None:
+        """Группа стала супергруппой: подписка переходит на новый chat_id."""
+        with self._lock:
+            self._conn.execute("DELETE FROM subscriptions WHERE chat_id = ?", (new_chat_id,))
+            self._conn.execute(
+                "UPDATE subscriptions SET chat_id = ? WHERE chat_id = ?", (new_chat_id, old_chat_id)
+            )
+            self._conn.commit()
+
+    def due(self, now_hhmm: str, today: str, max_failures: int) -> List[Subscription]:
+        """Подписки, время которых наступило, с недоставленной сегодня частью отчёта.
+
+        Чаты, исчерпавшие за сегодня max_failures попыток, пропускаются до следующего дня.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_id, formats, send_at, last_sent_xlsx, last_sent_text FROM subscriptions "
+                "WHERE send_at <= ? AND NOT (failed_day = ? AND failures >= ?) "
+                "AND ((formats IN ('xlsx', 'both') AND last_sent_xlsx != ?) "
+                "OR (formats IN ('text', 'both') AND last_sent_text != ?)) "
+                "ORDER BY send_at, chat_id",
+                (now_hhmm, today, max_failures, today, today),
+            ).fetchall()
+        return [Subscription(*row) for row in rows]
+
+    def mark_sent(self, chat_id: int, part: str, today: str) -> None:
+        column = {"xlsx": "last_sent_xlsx", "text": "last_sent_text"}[part]
+        with self._lock:
+            self._conn.execute(f"UPDATE subscriptions SET {column} = ? WHERE chat_id = ?", (today, chat_id))
+            self._conn.commit()
+
+    def record_failure(self, chat_id: int, today: str) -> int:
+        """Учитывает неудачную попытку за сегодня и возвращает их число."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE subscriptions SET failures = CASE WHEN failed_day = ? THEN failures + 1 ELSE 1 END, "
+                "failed_day = ? WHERE chat_id = ?",
+                (today, today, chat_id),
+            )
+            self._conn.commit()
+            row = self._conn.execute("SELECT failures FROM subscriptions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else 0
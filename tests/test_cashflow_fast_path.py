@@ -0,0 +1,123 @@
+"""Сверка быстрого пути build_excel_cashflow_table (без pandas) с путём через pandas."""
+import random
+
+import pandas as pd
+import pytest
+
+from cashflow import build_excel_cashflow_table
+
+
+ACCOUNTS = [
+    "Главная касса",
+    "Торговые кассы",
+    "Main cash register",
+    "Trade cash registers",
+    "Торговые кассы (ТК1)",
+    "Прочий счёт",
+]
+CATEGORIES = [
+    "Внутреннее перемещение",
+    "Internal transfer",
+    "Sales",
+    "Revenue",
+    "Выручка",
+    "Оплата накладных",
+    "Оплата труда",
+    "Подотчет",
+    "Предоплата",
+    "Займ",
+    "Loan",
+    "Прочее",
+]
+
+
+def _amount(rnd: random.Random, low: float, high: float):
+    return rnd.choice([round(rnd.uniform(low, high), 2), round(rnd.uniform(low, high), 2), None])
+
+
+def make_payload(seed: int, flows: int = 30, balances: bool = True) -> dict:
+    rnd = random.Random(seed)
+    data = []
+    if balances:
+        for account in ACCOUNTS[:5]:
+            data.append({
+                "Account.Name": account,
+                "CashFlowCategory.HierarchyLevel1": None,
+                "FinalBalance.Money": round(rnd.uniform(0, 1e5), 2),
+                "StartBalance.Money": round(rnd.uniform(0, 1e5), 2),
+            })
+    for _ in range(flows):
+        data.append({
+            "Account.Name": rnd.choice(ACCOUNTS),
+            "CashFlowCategory.HierarchyLevel1": rnd.choice(CATEGORIES),
+            "CashFlowCategory.HierarchyLevel2": rnd.choice([None, "A", "B"]),
+            "CashFlowCategory.Type": rnd.choice(["OPERATIONAL", "FINANCE"]),
+            "FinalBalance.Money": _amount(rnd, -1e4, 1e4),
+            "Sum.Incoming": _amount(rnd, 0, 5e3),
+            "Sum.Outgoing": _amount(rnd, 0, 5e3),
+        })
+    return {"data": data}
+
+
+def assert_paths_agree(prev: dict, curr: dict) -> None:
+    fast = build_excel_cashflow_table(prev, curr, fast_path=True)
+    slow = build_excel_cashflow_table(prev, curr, fast_path=False)
+    pd.testing.assert_frame_equal(fast, slow)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random_payloads(seed):
+    assert_paths_agree(make_payload(seed), make_payload(seed + 1000))
+
+
+def test_missing_account_name():
+    prev, curr = make_payload(1), make_payload(2)
+    for row in curr["data"][::3]:
+        del row["Account.Name"]
+    prev["data"].append({"CashFlowCategory.HierarchyLevel1": "Выручка", "FinalBalance.Money": 100.0})
+    assert_paths_agree(prev, curr)
+
+
+def test_no_account_name_at_all():
+    prev = {"data": [{"Sum.Incoming": 1.0, "CashFlowCategory.HierarchyLevel1": "Выручка"}]}
+    assert_paths_agree(prev, make_payload(3))
+
+
+def test_rows_without_l1_only():
+    prev = make_payload(4, flows=0)
+    curr = make_payload(5, flows=0)
+    assert_paths_agree(prev, curr)
+
+
+def test_no_balance_rows_falls_back_to_start_balances():
+    assert_paths_agree(make_payload(6), make_payload(7, balances=False))
+    assert_paths_agree(make_payload(8, balances=False), make_payload(9, balances=False))
+
+
+def test_empty_payloads():
+    assert_paths_agree({"data": []}, {"data": []})
+    assert_paths_agree({}, make_payload(10))
+
+
+def test_non_numeric_amounts():
+    prev, curr = make_payload(11), make_payload(12)
+    values = ["12.5", "abc", "", None, float("nan"), True, 7, "1e3"]
+    for i, row in enumerate(curr["data"]):
+        row["Sum.Incoming"] = values[i % len(values)]
+        row["FinalBalance.Money"] = values[(i + 3) % len(values)]
+    assert_paths_agree(prev, curr)
+
+
+def test_english_names_only():
+    prev = make_payload(13)
+    curr = {"data": [
+        {"Account.Name": "Main cash register", "CashFlowCategory.HierarchyLevel1": "Internal transfer",
+         "Sum.Incoming": 150.25, "FinalBalance.Money": 10.0},
+        {"Account.Name": "Trade cash registers", "CashFlowCategory.HierarchyLevel1": "Sales",
+         "Sum.Incoming": 99.99, "FinalBalance.Money": 5.5},
+        {"Account.Name": "Main cash register", "CashFlowCategory.HierarchyLevel1": "Loans",
+         "FinalBalance.Money": 1000.0},
+        {"Account.Name": "Trade cash registers", "CashFlowCategory.HierarchyLevel1": None,
+         "FinalBalance.Money": 321.0},
+    ]}
+    assert_paths_agree(prev, curr)